@@ -1,54 +1,65 @@
+import asyncio
 import os
 
 import pyxnat
 import typer
 from dotenv import load_dotenv
 
+from xnat_admin_tools.utils.async_common import AsyncXNAT
+from xnat_admin_tools.utils.client import close_clients
 from xnat_admin_tools.utils.common import (
+    HostCredentials,
     add_users_as_owners,
+    connect,
     create_new_project,
+    fetch_project_snapshots,
     set_project_settings,
     set_xsync_credentials,
 )
+from xnat_admin_tools.utils.metrics import enable_profile
 
 load_dotenv()
 
 app = typer.Typer()
 
 
-@app.command()
-def create_new_projects(project_id: str):
-    """
-    Create a project on server with the same settings on relay
-
-    This funtion creates a project on xnat server with same settings on the relay
-    Investigators are added as users
-    """
+def echo_response(response, what: str, project_id: str):
+    if response.status_code == 200:
+        typer.echo(response.text)
+    else:
+        typer.echo(
+            """Project {} for {} could not be set.
+                Please manually set the credentials""".format(
+                what, project_id
+            )
+        )
 
-    typer.echo("Creating project {} on XNAT server".format(project_id))
 
-    xrelay_host = os.environ.get("XNAT_RELAY_HOST", "")
-    xrelay_user = os.environ.get("XNAT_RELAY_USER", "")
-    xrelay_pass = os.environ.get("XNAT_RELAY_PASS", "")
-    xserver_host = os.environ.get("XNAT_SERVER_HOST", "")
-    xserver_user = os.environ.get("XNAT_SERVER_USER", "")
-    xserver_pass = os.environ.get("XNAT_SERVER_PASS", "")
+def create_project(
+    project_id: str,
+    source_connection: pyxnat.Interface,
+    dest_connection: pyxnat.Interface,
+    relay: HostCredentials,
+    server: HostCredentials,
+):
+    """Creates the project on the server, then sets up its XSync on the relay"""
+    xrelay_host, xrelay_user, xrelay_pass = relay
+    xserver_host, xserver_user, xserver_pass = server
 
-    # Establish connections to source and destination XNAT instances
-    source_connection = pyxnat.Interface(
-        server=xrelay_host, user=xrelay_user, password=xrelay_pass
-    )
-    dest_connection = pyxnat.Interface(
-        server=xserver_host, user=xserver_user, password=xserver_pass
-    )
+    # All project values in a single query on the relay
+    snapshot = fetch_project_snapshots(source_connection, [project_id]).get(project_id)
 
     project = create_new_project(
         project_id,
         source_connection,
         dest_connection,
+        snapshot,
     )
 
-    add_users_as_owners(project, project_id, source_connection, dest_connection)
+    if snapshot is not None:
+        add_users_as_owners(
+            project, project_id, source_connection, dest_connection, snapshot
+        )
 
     # set up Xsync project credentials
     response = set_project_settings(
@@ -59,15 +70,7 @@ def create_new_projects(project_id: str):
         project_id,
     )
 
-    if response.status_code == 200:
-        typer.echo(response.text)
-    else:
-        typer.echo(
-            """Project settings for {} could not be set.
-                Please manually set the credentials""".format(
-                project_id
-            )
-        )
+    echo_response(response, "settings", project_id)
 
     # Xsync settings
     # set up Xsync remote credentials
@@ -81,18 +84,107 @@ def create_new_projects(project_id: str):
         project_id,
     )
 
-    if response.status_code == 200:
-        typer.echo(response.text)
-    else:
-        typer.echo(
-            """Project credentials for {} could not be set.
-                Please manually set the credentials""".format(
-                project_id
+    echo_response(response, "credentials", project_id)
+
+
+async def create_project_async(
+    project_id: str,
+    source_connection: pyxnat.Interface,
+    dest_connection: pyxnat.Interface,
+    relay: HostCredentials,
+    server: HostCredentials,
+):
+    """
+    Same steps as create_project, with the independent calls to the relay
+    and the server run concurrently
+    """
+    client = AsyncXNAT()
+    xrelay_host, xrelay_user, xrelay_pass = relay
+    xserver_host, xserver_user, xserver_pass = server
+
+    # The relay snapshot, the server token and the relay's XSync settings
+    # do not depend on each other
+    snapshots, _, settings_response = await asyncio.gather(
+        client.fetch_project_snapshots(source_connection, [project_id]),
+        client.issue_token(xserver_host, xserver_user, xserver_pass),
+        client.set_project_settings(
+            xrelay_host, xrelay_user, xrelay_pass, xserver_host, project_id
+        ),
+    )
+    snapshot = snapshots.get(project_id)
+    echo_response(settings_response, "settings", project_id)
+
+    async def create():
+        project = await client.create_new_project(
+            project_id, source_connection, dest_connection, snapshot
+        )
+        if snapshot is not None:
+            await client.add_users_as_owners(
+                project, project_id, source_connection, dest_connection, snapshot
+            )
+
+    # The credentials need the XSync settings, not the project on the server
+    _, credentials_response = await asyncio.gather(
+        create(),
+        client.set_xsync_credentials(
+            xrelay_host,
+            xrelay_user,
+            xrelay_pass,
+            xserver_host,
+            xserver_user,
+            xserver_pass,
+            project_id,
+        ),
+    )
+    echo_response(credentials_response, "credentials", project_id)
+
+
+@app.command()
+def create_new_projects(
+    project_id: str,
+    use_async: bool = typer.Option(
+        False, "--async", help="Run independent relay and server calls concurrently"
+    ),
+    profile: bool = typer.Option(
+        False, help="Print the time spent per endpoint and host at exit"
+    ),
+):
+    """
+    Create a project on server with the same settings on relay
+
+    This funtion creates a project on xnat server with same settings on the relay
+    Investigators are added as users
+    """
+    if profile:
+        enable_profile()
+
+    typer.echo("Creating project {} on XNAT server".format(project_id))
+
+    xrelay_host = os.environ.get("XNAT_RELAY_HOST", "")
+    xrelay_user = os.environ.get("XNAT_RELAY_USER", "")
+    xrelay_pass = os.environ.get("XNAT_RELAY_PASS", "")
+    xserver_host = os.environ.get("XNAT_SERVER_HOST", "")
+    xserver_user = os.environ.get("XNAT_SERVER_USER", "")
+    xserver_pass = os.environ.get("XNAT_SERVER_PASS", "")
+
+    # Establish connections to source and destination XNAT instances
+    source_connection = connect(xrelay_host, xrelay_user, xrelay_pass)
+    dest_connection = connect(xserver_host, xserver_user, xserver_pass)
+
+    relay = (xrelay_host, xrelay_user, xrelay_pass)
+    server = (xserver_host, xserver_user, xserver_pass)
+    if use_async:
+        asyncio.run(
+            create_project_async(
+                project_id, source_connection, dest_connection, relay, server
             )
         )
+    else:
+        create_project(project_id, source_connection, dest_connection, relay, server)
 
     source_connection.disconnect()
     dest_connection.disconnect()
+    close_clients()
 
 
 def main():
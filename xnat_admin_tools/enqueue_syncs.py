@@ -0,0 +1,152 @@
+import os
+import sys
+import time
+from datetime import timedelta
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import typer
+from dotenv import load_dotenv
+from rq import Queue
+
+from xnat_admin_tools.initiate_sync import (
+    PENDING_KEY,
+    get_redis_queue,
+    record_scheduled_sync,
+    sync_job_options,
+    sync_project,
+)
+from xnat_admin_tools.utils.common import iter_sessions
+
+load_dotenv()
+
+app = typer.Typer()
+
+
+def read_experiments(lines: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """(experiment_id, label_id) from lines of "EXPERIMENT_ID [LABEL]" """
+    for line in lines:
+        fields = line.replace(",", " ").split()
+        if fields:
+            yield fields[0], fields[1] if len(fields) > 1 else fields[0]
+
+
+def batches(items: Iterable, size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def enqueue_batch(
+    redis_queue: Queue, batch: List[Tuple[str, str]], pending_ttl: int, delay: int
+) -> Tuple[int, int]:
+    """
+    Schedules sync_project `delay` seconds from now for a batch of experiments
+    in two pipelined round trips, with the same job options as schedule_sync,
+    skipping experiments that already have a pending sync.
+    Returns the number of jobs enqueued and skipped.
+    """
+    redis_conn = redis_queue.connection
+
+    with redis_conn.pipeline() as pipe:
+        for experiment_id, _ in batch:
+            pipe.set(
+                PENDING_KEY.format(experiment_id), "scheduling", nx=True, ex=pending_ttl
+            )
+        reserved = pipe.execute()
+
+    to_enqueue = [item for item, ok in zip(batch, reserved) if ok]
+    with redis_conn.pipeline() as pipe:
+        for experiment_id, label_id in to_enqueue:
+            job = redis_queue.enqueue_in(
+                timedelta(seconds=delay),
+                sync_project,
+                args=(experiment_id, label_id),
+                pipeline=pipe,
+                **sync_job_options(),
+            )
+            record_scheduled_sync(pipe, experiment_id, job.id, None, pending_ttl)
+        pipe.execute()
+
+    return len(to_enqueue), len(batch) - len(to_enqueue)
+
+
+@app.command()
+def enqueue_syncs(
+    source: Optional[str] = typer.Argument(
+        None,
+        help="File with one 'EXPERIMENT_ID [LABEL]' per line, - for stdin",
+    ),
+    project: Optional[str] = typer.Option(
+        None, help="Sync every session of this project on the relay instead"
+    ),
+    batch_size: int = typer.Option(100, help="Jobs enqueued per Redis round trip"),
+    rate: Optional[float] = typer.Option(
+        None, help="Maximum number of jobs enqueued per second"
+    ),
+    delay: Optional[int] = typer.Option(
+        None,
+        help="Seconds to wait before the first readiness check, "
+        "XSYNC_DELAY or 60 by default",
+    ),
+):
+    """
+    Enqueue xsync jobs for many experiments at once
+
+    Experiments come from a file, stdin or every session of a project on the
+    relay. All jobs go through a single Redis connection in pipelined batches.
+    """
+    experiments: Iterator[Tuple[str, str]]
+    if project:
+        xrelay_host = os.environ.get("XNAT_RELAY_HOST", "")
+        xrelay_user = os.environ.get("XNAT_RELAY_USER", "")
+        xrelay_pass = os.environ.get("XNAT_RELAY_PASS", "")
+        sessions = iter_sessions(
+            xrelay_host, xrelay_user, xrelay_pass, project, columns=["ID", "label"]
+        )
+        experiments = ((s["ID"], s["label"] or s["ID"]) for s in sessions)
+    elif source == "-":
+        experiments = read_experiments(sys.stdin)
+    elif source:
+        with open(source) as f:
+            experiments = read_experiments(f.readlines())
+    else:
+        typer.echo("Provide a file of experiment IDs, - for stdin, or --project")
+        raise typer.Exit(code=1)
+
+    if rate:
+        batch_size = max(1, min(batch_size, int(rate)))
+    pending_ttl = int(os.environ.get("XSYNC_PENDING_TTL", "86400"))
+    if delay is None:
+        delay = int(os.environ.get("XSYNC_DELAY", "60"))
+
+    redis_queue = get_redis_queue()
+    enqueued = skipped = 0
+    start = time.monotonic()
+
+    for batch in batches(experiments, batch_size):
+        batch_enqueued, batch_skipped = enqueue_batch(
+            redis_queue, batch, pending_ttl, delay
+        )
+        enqueued += batch_enqueued
+        skipped += batch_skipped
+        typer.echo(f"Enqueued {enqueued} jobs, {skipped} already pending")
+
+        if rate:
+            # Hold back until the jobs enqueued so far fit within the rate
+            wait = enqueued / rate - (time.monotonic() - start)
+            if wait > 0:
+                time.sleep(wait)
+
+    typer.echo(
+        f"Done: {enqueued} jobs enqueued, {skipped} skipped as already pending "
+        f"in {time.monotonic() - start:.1f}s"
+    )
+
+
+def main():
+    app()
@@ -0,0 +1,259 @@
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+import typer
+from dotenv import load_dotenv
+
+from xnat_admin_tools.initiate_sync import get_redis_queue
+from xnat_admin_tools.utils.client import closing_clients
+from xnat_admin_tools.utils.common import (
+    connect,
+    copy_project_settings,
+    create_new_project,
+    fetch_project_snapshots,
+    iter_projects,
+    set_xsync_credentials,
+    update_project,
+)
+from xnat_admin_tools.utils.fanout import enqueue_tasks, get_fanout_queue, wait_for_jobs
+from xnat_admin_tools.utils.metrics import timed_job
+from xnat_admin_tools.utils.pool import TaskResult, echo_summary
+from xnat_admin_tools.utils.project_diff import (
+    CREATE,
+    DELETE,
+    ProjectAction,
+    ProjectDiff,
+)
+from xnat_admin_tools.utils.tokens import get_token_provider
+
+load_dotenv()
+
+app = typer.Typer()
+
+
+def relay_credentials() -> Tuple[str, str, str]:
+    return (
+        os.environ.get("XNAT_RELAY_HOST", ""),
+        os.environ.get("XNAT_RELAY_USER", ""),
+        os.environ.get("XNAT_RELAY_PASS", ""),
+    )
+
+
+def server_credentials() -> Tuple[str, str, str]:
+    return (
+        os.environ.get("XNAT_SERVER_HOST", ""),
+        os.environ.get("XNAT_SERVER_USER", ""),
+        os.environ.get("XNAT_SERVER_PASS", ""),
+    )
+
+
+# Tasks run by the RQ workers. Credentials come from the worker's environment
+# so they are never stored in Redis. The default worker forks for every job,
+# so each task opens its own connections and closes them when done, and alias
+# tokens are shared through Redis rather than issued per job.
+
+
+@timed_job
+@closing_clients
+def renew_project_task(project_id: str):
+    """Renews the XSync credentials of a relay project"""
+    from rq import get_current_job
+
+    job = get_current_job()
+    if job:
+        get_token_provider(*server_credentials(), redis_conn=job.connection)
+
+    response = set_xsync_credentials(
+        *relay_credentials(), *server_credentials(), project_id
+    )
+    if response.status_code != 200:
+        raise RuntimeError(
+            f"status code {response.status_code}: {response.text.strip()}"
+        )
+    return response.status_code
+
+
+@timed_job
+@closing_clients
+def replicate_project_task(
+    src_host: str, dst_host: str, kind: str, project_id: str, snapshot: dict
+):
+    """Creates or updates a project of `src_host` on `dst_host`, then copies
+    its XSync settings"""
+    user = os.environ.get("XNAT_SERVER_USER", "")
+    password = os.environ.get("XNAT_SERVER_PASS", "")
+    src_conn = connect(src_host, user, password)
+    dst_conn = connect(dst_host, user, password)
+    try:
+        if kind == CREATE:
+            create_new_project(project_id, src_conn, dst_conn, snapshot)
+        else:
+            update_project(project_id, dst_conn, snapshot)
+    finally:
+        src_conn.disconnect()
+        dst_conn.disconnect()
+
+    # copy_project_settings reads from its second host, writes to its first
+    response = copy_project_settings(
+        dst_host, user, password, src_host, user, password, project_id
+    )
+    if response.status_code != 200:
+        raise RuntimeError(
+            "project settings could not be set, please set them manually "
+            f"(status code {response.status_code}: {response.text})"
+        )
+    return response.status_code
+
+
+@timed_job
+@closing_clients
+def delete_subjects_task(project_id: str, subject_ids: List[str], dry_run: bool):
+    """Deletes subjects of a relay project, returns the number deleted"""
+    connection = connect(*relay_credentials())
+    project = connection.select.project(project_id)
+
+    errors = []
+    for subject_id in subject_ids:
+        try:
+            if not dry_run:
+                project.subject(subject_id).delete()
+        except Exception as e:
+            errors.append(f"{subject_id} ({e})")
+    connection.disconnect()
+
+    if errors:
+        raise RuntimeError(
+            f"{len(errors)} of {len(subject_ids)} subjects not deleted: "
+            + ", ".join(errors)
+        )
+    return len(subject_ids)
+
+
+def run_tasks(func, tasks: list, wait: bool, timeout: Optional[float]):
+    """Enqueues the tasks and, with `wait`, reports their outcome as they end"""
+    redis_conn = get_redis_queue().connection
+    queue = get_fanout_queue(redis_conn)
+    jobs = enqueue_tasks(queue, func, tasks)
+    typer.echo(f"Enqueued {len(jobs)} jobs on the {queue.name} queue")
+    if not wait:
+        return None
+
+    start = time.monotonic()
+    done = 0
+
+    def report(result: TaskResult):
+        nonlocal done
+        done += 1
+        status = "ok" if result.ok else f"failed ({result.error})"
+        typer.echo(f"[{done}/{len(jobs)}] {result.item}: {status}")
+
+    results = wait_for_jobs(redis_conn, jobs, timeout=timeout, on_result=report)
+    echo_summary(results, time.monotonic() - start, "jobs")
+    return results
+
+
+@app.command()
+def renew_tokens(
+    wait: bool = typer.Option(True, help="Wait for the jobs and report their outcome"),
+    timeout: Optional[float] = typer.Option(None, help="Seconds to wait at most"),
+):
+    """Renews the XSync credentials of every relay project, one job per project"""
+    projects = iter_projects(*relay_credentials(), columns=["ID"])
+    tasks = [(project["ID"], (project["ID"],)) for project in projects]
+
+    results = run_tasks(renew_project_task, tasks, wait, timeout)
+    if results and not all(result.ok for result in results):
+        raise typer.Exit(code=1)
+
+
+@app.command()
+def replicate_projects(
+    wait: bool = typer.Option(True, help="Wait for the jobs and report their outcome"),
+    timeout: Optional[float] = typer.Option(None, help="Seconds to wait at most"),
+    state_file: Optional[str] = typer.Option(
+        None, help="Project state from the last run, kept in the cache dir by default"
+    ),
+):
+    """Replicates the projects that changed on production to QA, one job per
+    project. The project state is only updated when waiting for the jobs."""
+    prod_xserver_host = os.environ.get("PROD_XNAT_SERVER_HOST", "")
+    qa_xserver_host = os.environ.get("QA_XNAT_SERVER_HOST", "")
+    xserver_user = os.environ.get("XNAT_SERVER_USER", "")
+    xserver_pass = os.environ.get("XNAT_SERVER_PASS", "")
+
+    prod_connection = connect(prod_xserver_host, xserver_user, xserver_pass)
+    snapshots = fetch_project_snapshots(prod_connection)
+    prod_connection.disconnect()
+    qa_projects = iter_projects(
+        qa_xserver_host, xserver_user, xserver_pass, columns=["ID"]
+    )
+
+    diff = ProjectDiff(prod_xserver_host, qa_xserver_host, state_file)
+    actions: List[ProjectAction] = []
+    for action in diff.actions(snapshots, {project["ID"] for project in qa_projects}):
+        if action.kind == DELETE:
+            typer.echo(f"{action.project_id} is no longer on prod, left as is on QA")
+            diff.record(action)
+        else:
+            actions.append(action)
+
+    tasks = [
+        (
+            action,
+            (
+                prod_xserver_host,
+                qa_xserver_host,
+                action.kind,
+                action.project_id,
+                action.snapshot,
+            ),
+        )
+        for action in actions
+    ]
+    results = run_tasks(replicate_project_task, tasks, wait, timeout)
+
+    # Failed projects are retried on the next run
+    for result in results or []:
+        if result.ok:
+            diff.record(result.item)
+    diff.save()
+
+
+@app.command()
+def cleanup(
+    days: int,
+    dry_run: bool = typer.Option(
+        False, help="Whether to actually delete or nor the data"
+    ),
+    wait: bool = typer.Option(True, help="Wait for the jobs and report their outcome"),
+    timeout: Optional[float] = typer.Option(None, help="Seconds to wait at most"),
+):
+    """Deletes the relay subjects with sessions older than `days` days,
+    one job per project"""
+    from xnat_admin_tools.remove_stale_data import find_stale_sessions
+
+    xrelay_host, xrelay_user, xrelay_pass = relay_credentials()
+    connection = connect(xrelay_host, xrelay_user, xrelay_pass)
+    sessions = find_stale_sessions(connection, days)
+    connection.disconnect()
+
+    subjects: Dict[str, Dict[str, None]] = {}
+    for session in sessions:
+        subjects.setdefault(session["project"], {})[session["subject_id"]] = None
+    typer.echo(
+        f"Found {len(sessions)} sessions of "
+        f"{sum(len(s) for s in subjects.values())} subjects in {len(subjects)} projects"
+    )
+
+    tasks = [
+        (project_id, (project_id, list(subject_ids), dry_run))
+        for project_id, subject_ids in subjects.items()
+    ]
+    results = run_tasks(delete_subjects_task, tasks, wait, timeout)
+    if results:
+        typer.echo(f"Deleted {sum(r.value for r in results if r.ok)} subjects")
+
+
+def main():
+    app()
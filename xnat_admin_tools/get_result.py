@@ -1,7 +1,18 @@
 import os
+import time
+from typing import Dict, List, Optional, Tuple
 
 import typer
 from rq.job import Job
+from rq.registry import FailedJobRegistry, FinishedJobRegistry, StartedJobRegistry
+
+from xnat_admin_tools.initiate_sync import latest_sync_job_id, sync_root_job_id
+from xnat_admin_tools.utils.sync_tracking import (
+    get_tracking,
+    percentile,
+    summarize,
+    tracked_syncs,
+)
 
 app = typer.Typer()
 
@@ -21,14 +32,151 @@ def get_redis_queue():
     return redis_conn
 
 
+def format_tracking(record: Dict[str, str]) -> str:
+    """One line summary of a tracked sync"""
+    triggered = time.strftime(
+        "%Y-%m-%d %H:%M:%S", time.localtime(float(record["triggered"]))
+    )
+    line = "{:<20} {:<20} {:<10} {}".format(
+        record["experiment_id"], record["label_id"], record["status"], triggered
+    )
+    if record.get("duration"):
+        line += " {:>10.0f}s {:>14} bytes {:>8.2f} MB/s".format(
+            float(record["duration"]),
+            record["bytes"],
+            float(record.get("throughput") or 0) / 1e6,
+        )
+    return line
+
+
+def show_tracked(redis_conn, limit: int):
+    records = tracked_syncs(redis_conn, limit)
+    for record in records:
+        typer.echo(format_tracking(record))
+
+    summary = summarize(records)
+    counts = ", ".join(f"{n} {status}" for status, n in summary["counts"].items())
+    typer.echo(f"\n{len(records)} syncs: {counts or 'none tracked'}")
+    typer.echo(
+        "Latency p50 {:.0f}s, p95 {:.0f}s, max {:.0f}s".format(
+            summary["p50"], summary["p95"], summary["max"]
+        )
+    )
+    typer.echo(
+        "Transferred {} bytes, {:.2f} MB/s overall".format(
+            summary["bytes"], summary["throughput"] / 1e6
+        )
+    )
+
+
+def registry_jobs(redis_conn, queue_name: str) -> List[Tuple[str, Job]]:
+    """
+    (status, job) of every job in the queue's started, finished and failed
+    registries, read in two pipelined round trips
+    """
+    registries = {
+        "started": StartedJobRegistry(queue_name, connection=redis_conn),
+        "finished": FinishedJobRegistry(queue_name, connection=redis_conn),
+        "failed": FailedJobRegistry(queue_name, connection=redis_conn),
+    }
+    with redis_conn.pipeline() as pipe:
+        for registry in registries.values():
+            pipe.zrange(registry.key, 0, -1)
+        ids_per_registry = pipe.execute()
+
+    statuses = [
+        (status, job_id.decode())
+        for status, job_ids in zip(registries, ids_per_registry)
+        for job_id in job_ids
+    ]
+    jobs = Job.fetch_many([job_id for _, job_id in statuses], connection=redis_conn)
+    return [(status, job) for (status, _), job in zip(statuses, jobs) if job]
+
+
+def show_jobs(redis_conn, queue_name: str, failures: int):
+    """Counts, run time percentiles and latest failures per job function"""
+    rows: Dict[str, dict] = {}
+    failed: List[Job] = []
+    for status, job in registry_jobs(redis_conn, queue_name):
+        row = rows.setdefault(
+            job.func_name.rsplit(".", 1)[-1],
+            {"started": 0, "finished": 0, "failed": 0, "durations": []},
+        )
+        row[status] += 1
+        if job.started_at and job.ended_at:
+            row["durations"].append((job.ended_at - job.started_at).total_seconds())
+        if status == "failed":
+            failed.append(job)
+
+    typer.echo(
+        f"{'JOB':<20} {'STARTED':>8} {'FINISHED':>8} {'FAILED':>8} "
+        f"{'P50':>8} {'P95':>8} {'MAX':>8}"
+    )
+    for name, row in sorted(rows.items()):
+        durations = row["durations"]
+        typer.echo(
+            f"{name:<20} {row['started']:>8} {row['finished']:>8} {row['failed']:>8} "
+            f"{percentile(durations, 50):>7.1f}s {percentile(durations, 95):>7.1f}s "
+            f"{max(durations, default=0.0):>7.1f}s"
+        )
+
+    failed.sort(key=lambda job: job.ended_at or job.created_at, reverse=True)
+    if failed:
+        typer.echo(f"\nLatest {min(failures, len(failed))} of {len(failed)} failures")
+    for job in failed[:failures]:
+        error = (job.exc_info or "").strip().splitlines() or ["no exception info"]
+        typer.echo(f"{job.id} {job.description}: {error[-1]}")
+
+
 @app.command()
-def get_result(job_id):
-    """Takes a job_id and returns the job's result."""
+def get_result(
+    job_id: Optional[str] = typer.Argument(
+        None, help="Job to report on, all recently tracked syncs if omitted"
+    ),
+    limit: int = typer.Option(100, help="Number of tracked syncs to summarize"),
+    jobs: bool = typer.Option(
+        False,
+        help="Summarize the jobs in the queue's started, finished and failed "
+        "registries instead of the tracked syncs",
+    ),
+    queue: str = typer.Option("default", help="Queue whose registries are read"),
+    failures: int = typer.Option(10, help="Number of latest failures listed"),
+    watch: Optional[float] = typer.Option(
+        None, help="Refresh the summary every WATCH seconds"
+    ),
+):
+    """Takes a job_id and returns the job's result. Without a job_id,
+    lists the latest tracked syncs with their latency and throughput,
+    or with --jobs the status of every job in the queue's registries."""
 
     redis_conn = get_redis_queue()
 
+    if job_id is None:
+        while True:
+            if watch:
+                typer.clear()
+            if jobs:
+                show_jobs(redis_conn, queue, failures)
+            else:
+                show_tracked(redis_conn, limit)
+            if not watch:
+                return
+            try:
+                time.sleep(watch)
+            except KeyboardInterrupt:
+                return
+
     job = Job.fetch(job_id, connection=redis_conn)
 
+    # A sync reschedules itself as new jobs, report on the latest one
+    root_job_id = sync_root_job_id(job)
+    latest_job_id = latest_sync_job_id(redis_conn, root_job_id)
+    if root_job_id != job.id:
+        typer.echo("Job {} of the sync started by {}".format(job.id, root_job_id))
+    if latest_job_id and latest_job_id != job.id:
+        typer.echo("Latest job of the sync: {}".format(latest_job_id))
+        job = Job.fetch(latest_job_id, connection=redis_conn)
+
     typer.echo("Is the job queued: {}".format(job.is_queued))
     typer.echo("Is the job failed: {}".format(job.is_failed))
     typer.echo("Is the job started: {}".format(job.is_started))
@@ -42,6 +190,11 @@ def get_result(job_id):
     else:
         typer.echo("Results: {}".format(job.result))
 
+    # Tracking records carry the first job ID of the sync
+    record = get_tracking(redis_conn, job.args[0]) if job.args else {}
+    if record and record.get("job_id") == root_job_id:
+        typer.echo("Sync: {}".format(format_tracking(record)))
+
 
 def main():
     app()
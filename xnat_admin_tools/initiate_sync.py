@@ -1,12 +1,35 @@
 import os
+import random
+from datetime import timedelta
+from typing import Callable, Optional, Tuple
 
 import typer
 from dotenv import load_dotenv
 
+from xnat_admin_tools.utils.client import closing_clients
+from xnat_admin_tools.utils.metrics import timed, timed_job
+from xnat_admin_tools.utils.sync_limiter import SyncLimiter
+from xnat_admin_tools.utils.sync_tracking import (
+    files_signature,
+    schedule_tracking,
+    start_tracking,
+)
+
 load_dotenv()
 
 app = typer.Typer()
 
+# Holds the ID of the job pending for an experiment
+PENDING_KEY = "xsync:pending:{}"
+# Syncs that stayed locked after XSYNC_LOCK_MAX_RETRIES retries
+DEAD_LETTER_QUEUE = "xsync-dead-letter"
+# Statuses of a job that will not run (again)
+ENDED_STATUSES = ("finished", "failed", "stopped", "canceled")
+# Holds the ID of the latest job of a sync, keyed by the ID of its first job
+LATEST_KEY = "xsync:latest:{}"
+# Seconds the results of sync jobs are kept
+RESULT_TTL = 604800
+
 
 def get_redis_queue():
     """
@@ -24,42 +47,154 @@ def get_redis_queue():
     return Queue(connection=redis_conn)
 
 
-def sync_project(experiment_id, label_id):
+def session_signature(experiment_id) -> Optional[Tuple[int, int]]:
+    """
+    Number of files and total bytes of an experiment's scans on the relay,
+    None if they could not be listed
+    """
+    xrelay_host = os.environ.get("XNAT_RELAY_HOST", "")
+    xrelay_user = os.environ.get("XNAT_RELAY_USER", "")
+    xrelay_pass = os.environ.get("XNAT_RELAY_PASS", "")
+
+    return files_signature(
+        xrelay_host,
+        xrelay_user,
+        xrelay_pass,
+        f"/data/experiments/{experiment_id}/scans/ALL/files",
+    )
+
+
+@timed_job
+@closing_clients
+def sync_project(experiment_id, label_id, previous=None, check=0, lock_retries=0):
     """
     Basic method to initiated sync
 
     This method intiates a sync -
-        1) The method runs via a redis queue
-        2) If the respose code == 423 the method is requeued
-        3) skip sync if the project was already synced
-    """
-    import time
+        1) The method runs via a redis queue, scheduled by schedule_sync
+        2) The sync waits until the session stopped changing: the files of
+           the experiment are counted on every run and the job reschedules
+           itself with exponential backoff until two counts match
+        3) If the respose code == 423 the method is requeued with exponential
+           backoff and jitter, up to XSYNC_LOCK_MAX_RETRIES times, after which
+           it is moved to the dead letter queue
+        4) At most XSYNC_MAX_IN_FLIGHT syncs (and XSYNC_RATE per second) are
+           triggered on the relay at once across all workers, otherwise the
+           job is rescheduled shortly after
+        5) A started sync is tracked by track_sync until its files reach
+           the server
+        6) skip sync if the project was already synced
 
+    Every reschedule is a new job, they all carry the ID of the first one
+    (the JOB_ID printed by xnat-sync-project) in job.meta["root_job_id"].
+    """
     import requests
     from requests.auth import HTTPBasicAuth
+    from rq import get_current_job
 
     xrelay_host = os.environ.get("XNAT_RELAY_HOST", "")
     xrelay_user = os.environ.get("XNAT_RELAY_USER", "")
     xrelay_pass = os.environ.get("XNAT_RELAY_PASS", "")
 
-    # Sleep till data is available for transfer
-    # This container can get prematurely for large datasets
-    # If we see file lock errors we might need to increase this
-    # waitime
-    time.sleep(300)
+    base_delay = int(os.environ.get("XSYNC_READY_BASE_DELAY", "30"))
+    max_delay = int(os.environ.get("XSYNC_READY_MAX_DELAY", "600"))
+    max_checks = int(os.environ.get("XSYNC_READY_MAX_CHECKS", "8"))
+    max_lock_retries = int(os.environ.get("XSYNC_LOCK_MAX_RETRIES", "5"))
+
+    job = get_current_job()
+    root_job_id = sync_root_job_id(job) if job else None
+
+    signature = session_signature(experiment_id)
+    ready = signature is not None and signature[0] > 0 and signature == previous
+    if not ready and check < max_checks:
+        delay = min(base_delay * 2**check, max_delay)
+        schedule_sync(
+            experiment_id,
+            label_id,
+            delay,
+            signature,
+            check + 1,
+            lock_retries,
+            True,
+            root_job_id,
+        )
+        return "session {} not ready ({}), checking again in {}s".format(
+            experiment_id, signature, delay
+        )
+
+    # Take a slot on the relay rather than piling up on its locks
+    limiter = SyncLimiter(get_redis_queue().connection, xrelay_host)
+    token = limiter.try_acquire()
+    if token is None:
+        delay = int(random.uniform(base_delay / 2, base_delay))
+        schedule_sync(
+            experiment_id,
+            label_id,
+            delay,
+            signature,
+            check,
+            lock_retries,
+            True,
+            root_job_id,
+        )
+        return "relay busy ({} syncs in flight), retrying in {}s".format(
+            limiter.in_flight(), delay
+        )
+
     post_url = xrelay_host + "/xapi/xsync/syncexperiment/" + experiment_id
     basic = HTTPBasicAuth(xrelay_user, xrelay_pass)
-    response = requests.request(
-        "POST",
-        post_url,
-        headers={"Content-Type": "application/json"},
-        auth=basic,
-    )
+    started = False
+    try:
+        with timed("http", "POST", post_url) as call:
+            response = requests.request(
+                "POST",
+                post_url,
+                headers={"Content-Type": "application/json"},
+                auth=basic,
+            )
+            call["error"] = response.status_code >= 400
+        started = response.status_code == 200
+    finally:
+        # A started sync keeps its slot, renewed by track_sync until it lands
+        if not started:
+            limiter.release(token)
 
     if response.status_code == 423:
-        enqueue_sync(experiment_id, label_id)
-        return "xsync servers LOCKED: status code {}".format(response.status_code)
-    elif response.status_code == 200:
+        if lock_retries >= max_lock_retries:
+            dead_letter_sync(experiment_id, label_id, root_job_id)
+            return "xsync servers LOCKED {} times, moved to {}".format(
+                lock_retries + 1, DEAD_LETTER_QUEUE
+            )
+
+        # Equal jitter: half the backoff is fixed, the other half random
+        backoff = min(base_delay * 2**lock_retries, max_delay)
+        delay = int(backoff / 2 + random.uniform(0, backoff / 2))
+        schedule_sync(
+            experiment_id,
+            label_id,
+            delay,
+            signature,
+            check,
+            lock_retries + 1,
+            True,
+            root_job_id,
+        )
+        return "xsync servers LOCKED: status code {}, retrying in {}s".format(
+            response.status_code, delay
+        )
+
+    clear_pending_sync(experiment_id)
+    if response.status_code == 200:
+        redis_queue = get_redis_queue()
+        start_tracking(
+            redis_queue.connection,
+            experiment_id,
+            label_id,
+            root_job_id,
+            signature,
+            token,
+        )
+        schedule_tracking(redis_queue, experiment_id, label_id)
         return "xsync on {} started".format(experiment_id)
     else:
         return "xsync could not be completed. Status code : {}".format(
@@ -67,15 +202,189 @@ def sync_project(experiment_id, label_id):
         )
 
 
-@app.command()
-def enqueue_sync(experiment_id, label_id):
+def schedule_sync(
+    experiment_id,
+    label_id,
+    delay: Optional[int] = None,
+    previous: Optional[Tuple[int, int]] = None,
+    check: int = 0,
+    lock_retries: int = 0,
+    replace: bool = False,
+    root_job_id: Optional[str] = None,
+):
+    """
+    Schedules sync_project to run `delay` seconds from now (XSYNC_DELAY,
+    60 by default), when it first checks whether the data is ready for transfer
+
+    Only one sync is pending per experiment: returns None if one already is,
+    unless `replace` is set (used by the pending job to reschedule itself).
+    A pending job that ended without clearing its claim (it raised, timed out
+    or its worker died) no longer counts as pending.
+    A rescheduled job passes the `root_job_id` of the sync on.
+    The job waits in the queue's scheduled registry rather than in a worker,
+    workers must be started with `rq worker --with-scheduler`.
+    """
+    if delay is None:
+        delay = int(os.environ.get("XSYNC_DELAY", "60"))
+    pending_ttl = int(os.environ.get("XSYNC_PENDING_TTL", "86400"))
 
     redis_queue = get_redis_queue()
-    job = redis_queue.enqueue(
-        sync_project, args=(experiment_id, label_id), job_timeout=600, result_ttl=604800
+    pending_key = PENDING_KEY.format(experiment_id)
+    reserved = redis_queue.connection.set(
+        pending_key, "scheduling", nx=not replace, ex=pending_ttl
     )
+    if not reserved and release_ended_pending_sync(
+        redis_queue.connection, experiment_id
+    ):
+        reserved = redis_queue.connection.set(
+            pending_key, "scheduling", nx=True, ex=pending_ttl
+        )
+    if not reserved:
+        return None
+
+    job = redis_queue.enqueue_in(
+        timedelta(seconds=delay),
+        sync_project,
+        args=(experiment_id, label_id, previous, check, lock_retries),
+        **sync_job_options(root_job_id),
+    )
+    with redis_queue.connection.pipeline() as pipe:
+        record_scheduled_sync(pipe, experiment_id, job.id, root_job_id, pending_ttl)
+        pipe.execute()
+
+    return job
+
+
+def sync_job_options(root_job_id: Optional[str] = None) -> dict:
+    """
+    Enqueue options of every sync_project job, whichever way it is scheduled
+    """
+    return {
+        "job_timeout": 600,
+        "result_ttl": RESULT_TTL,
+        "meta": {"root_job_id": root_job_id} if root_job_id else None,
+        "on_failure": sync_failed,
+    }
+
+
+def record_scheduled_sync(
+    pipe, experiment_id, job_id: str, root_job_id: Optional[str], pending_ttl: int
+):
+    """Points the experiment's pending claim and its sync at a scheduled job"""
+    pipe.set(PENDING_KEY.format(experiment_id), job_id, ex=pending_ttl)
+    pipe.set(LATEST_KEY.format(root_job_id or job_id), job_id, ex=RESULT_TTL)
 
-    typer.echo("Job started - JOB_ID: {}".format(job.id))
+
+def sync_root_job_id(job) -> str:
+    """ID of the first job of the sync `job` belongs to"""
+    return job.meta.get("root_job_id", job.id)
+
+
+def latest_sync_job_id(redis_conn, root_job_id: str) -> Optional[str]:
+    """ID of the latest job of the sync started by `root_job_id`, if known"""
+    job_id = redis_conn.get(LATEST_KEY.format(root_job_id))
+    return job_id.decode() if job_id else None
+
+
+def pending_sync(experiment_id) -> Optional[str]:
+    """ID of the job pending for an experiment, if any"""
+    job_id = get_redis_queue().connection.get(PENDING_KEY.format(experiment_id))
+    return job_id.decode() if job_id else None
+
+
+def clear_pending_sync(experiment_id):
+    get_redis_queue().connection.delete(PENDING_KEY.format(experiment_id))
+
+
+def _clear_pending_if(redis_conn, experiment_id, ended: Callable[[str], bool]) -> bool:
+    """
+    Clears the pending claim of an experiment if `ended(job_id)` holds for the
+    job holding it, unless the claim changes meanwhile. Returns whether it was
+    cleared.
+    """
+    import redis
+
+    pending_key = PENDING_KEY.format(experiment_id)
+    with redis_conn.pipeline() as pipe:
+        try:
+            pipe.watch(pending_key)
+            job_id = pipe.get(pending_key)
+            # released, or still being scheduled
+            if job_id is None or job_id == b"scheduling":
+                return False
+            if not ended(job_id.decode()):
+                return False
+
+            pipe.multi()
+            pipe.delete(pending_key)
+            pipe.execute()
+            return True
+        except redis.WatchError:
+            return False
+
+
+def release_ended_pending_sync(redis_conn, experiment_id) -> bool:
+    """
+    Clears the pending claim of an experiment if the job holding it ended or
+    expired without clearing it (e.g. its worker died). Returns whether it was
+    cleared.
+    """
+    from rq.job import Job
+
+    def ended(job_id: str) -> bool:
+        job = Job.fetch_many([job_id], connection=redis_conn)[0]
+        return job is None or job.get_status(refresh=False) in ENDED_STATUSES
+
+    return _clear_pending_if(redis_conn, experiment_id, ended)
+
+
+def sync_failed(job, connection, type, value, traceback):
+    """
+    RQ failure callback of sync_project: a job that raised or timed out frees
+    its experiment for the next enqueue
+    """
+    _clear_pending_if(connection, job.args[0], lambda job_id: job_id == job.id)
+
+
+def dead_letter_sync(experiment_id, label_id, root_job_id: Optional[str] = None):
+    """
+    Parks a sync that kept failing on the dead letter queue, which no worker
+    listens to. Run `rq worker xsync-dead-letter --burst` to retry them.
+    """
+    from rq import Queue
+
+    redis_queue = get_redis_queue()
+    job = Queue(DEAD_LETTER_QUEUE, connection=redis_queue.connection).enqueue(
+        sync_project,
+        args=(experiment_id, label_id),
+        **sync_job_options(root_job_id),
+    )
+    if root_job_id:
+        redis_queue.connection.set(
+            LATEST_KEY.format(root_job_id), job.id, ex=RESULT_TTL
+        )
+    clear_pending_sync(experiment_id)
+
+
+@app.command()
+def enqueue_sync(
+    experiment_id,
+    label_id,
+    delay: Optional[int] = typer.Option(
+        None,
+        help="Seconds to wait before the first readiness check, "
+        "XSYNC_DELAY or 60 by default",
+    ),
+):
+
+    job = schedule_sync(experiment_id, label_id, delay)
+
+    if job is None:
+        typer.echo(
+            "Sync already pending - JOB_ID: {}".format(pending_sync(experiment_id))
+        )
+    else:
+        typer.echo("Job started - JOB_ID: {}".format(job.id))
 
 
 def main():
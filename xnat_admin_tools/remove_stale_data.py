@@ -1,30 +1,45 @@
 import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime, timedelta
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+)
 
 import psutil
 import pyxnat
 import typer
 from dotenv import load_dotenv
 
+from xnat_admin_tools.utils.archive_usage import ArchiveUsage
+from xnat_admin_tools.utils.common import connect
+from xnat_admin_tools.utils.metrics import enable_profile
+
 load_dotenv()
 
 app = typer.Typer()
 
 
-def remove_stale(connection: pyxnat.Interface, days: int, dry_run: bool = False):
-    """Removes participant data form an XNAT host that is older
-    than the specified number of days"""
-    typer.echo(f"Searching sessions older than {days} days")
+def find_stale_sessions(connection: pyxnat.Interface, days: int) -> List[dict]:
+    """Sessions inserted on the XNAT host more than `days` days ago"""
     now = datetime.now()
     cutoff = now - timedelta(days=days)
     date_time = cutoff.strftime("%Y-%m-%d, %H:%M:%S")
-    to_delete = (
+    return (
         connection.select(
             "xnat:mrSessionData",
             [
                 "xnat:mrSessionData/PROJECT",
                 "xnat:mrSessionData/SUBJECT_ID",
                 "xnat:mrSessionData/SUBJECT_LABEL",
+                "xnat:mrSessionData/LABEL",
                 "xnat:mrSessionData/INSERT_DATE",
             ],
         )
@@ -32,17 +47,246 @@ def remove_stale(connection: pyxnat.Interface, days: int, dry_run: bool = False)
         .data
     )
 
-    typer.echo(f"Found {len(to_delete)} sessions")
-    for session in to_delete:
-        typer.echo(f"Deleting {session}")
-        p = connection.select.project(session["project"])
+
+def delete_subjects(
+    connection: pyxnat.Interface,
+    sessions: Iterable[dict],
+    dry_run: bool = False,
+    workers: int = 1,
+    path: Optional[str] = None,
+    processed: Optional[Set[Tuple[str, str]]] = None,
+    stop: Optional[Callable[[], bool]] = None,
+) -> Set[Tuple[str, str]]:
+    """
+    Delete the subjects of a list of sessions through a bounded pool of workers
+
+    Subjects are deduplicated and each project is selected once. Subjects in
+    `processed` are skipped and every subject attempted is added to it. No new
+    deletion is started once `stop()` returns True. Progress, subjects/sec and,
+    when `path` is given, the bytes freed on that disk are reported as
+    deletions complete.
+    """
+    processed = processed if processed is not None else set()
+
+    # Unique (project, subject) pairs, in the order they were found
+    keys = ((session["project"], session["subject_id"]) for session in sessions)
+    subjects = list(dict.fromkeys(key for key in keys if key not in processed))
+
+    if not subjects:
+        return processed
+
+    projects = {
+        project: connection.select.project(project)
+        for project in {project for project, _ in subjects}
+    }
+
+    def delete(key: Tuple[str, str]):
+        project, subject_id = key
+        typer.echo(f"Deleting subject {subject_id} from project {project}")
         if not dry_run:
-            try:
-                p.subject(session["subject_id"]).delete()
-            except Exception as e:
-                typer.echo(
-                    f"Error {e}: Unable to delete session {session} from archive."
-                )
+            projects[project].subject(subject_id).delete()
+
+    used_before = psutil.disk_usage(path).used if path else 0
+    start = time.monotonic()
+    done = 0
+
+    def report(key: Tuple[str, str], error: Optional[BaseException]):
+        nonlocal done
+        done += 1
+        if error:
+            typer.echo(
+                f"Error {error}: Unable to delete subject {key[1]} "
+                f"of project {key[0]} from archive."
+            )
+        rate = done / (time.monotonic() - start)
+        freed = (
+            f", {used_before - psutil.disk_usage(path).used} bytes freed"
+            if path
+            else ""
+        )
+        typer.echo(f"[{done}/{len(subjects)}] {rate:.2f} subjects/sec{freed}")
+
+    remaining = iter(subjects)
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        pending: dict = {}
+        while True:
+            while len(pending) < max(workers, 1) and not (stop and stop()):
+                next_key = next(remaining, None)
+                if next_key is None:
+                    break
+                processed.add(next_key)
+                pending[executor.submit(delete, next_key)] = next_key
+
+            if not pending:
+                break
+
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                report(pending.pop(future), future.exception())
+
+    return processed
+
+
+def plan_deletions(
+    sessions: Iterable[dict], size: Callable[[dict], int], bytes_to_free: int
+) -> List[dict]:
+    """
+    Pick the oldest subjects whose deletion frees at least `bytes_to_free`
+
+    A subject is as old as its oldest session and its size is the sum of the
+    sizes of its sessions. Returns the subjects to delete, oldest first.
+    """
+    subjects: Dict[Tuple[str, str], dict] = {}
+    for session in sessions:
+        key = (session["project"], session["subject_id"])
+        subject = subjects.setdefault(
+            key,
+            {
+                "project": session["project"],
+                "subject_id": session["subject_id"],
+                "insert_date": session["insert_date"],
+                "size": 0,
+            },
+        )
+        subject["insert_date"] = min(subject["insert_date"], session["insert_date"])
+        subject["size"] += size(session)
+
+    plan = []
+    planned_bytes = 0
+    for subject in sorted(subjects.values(), key=lambda s: s["insert_date"]):
+        if planned_bytes >= bytes_to_free:
+            break
+        plan.append(subject)
+        planned_bytes += subject["size"]
+
+    return plan
+
+
+def remove_planned(
+    connection: pyxnat.Interface,
+    path: str,
+    archive_path: str,
+    percent: int,
+    min_days: int,
+    dry_run: bool = False,
+    workers: int = 1,
+    scan_workers: int = 8,
+):
+    """
+    Deletes the oldest subjects, just enough to bring `path` under `percent`
+
+    The target is measured like psutil's percent, used / (used + free), which
+    leaves out blocks reserved for root. If the plan falls short (sizes from the
+    archive need not match what the disk frees), the remaining stale subjects
+    are deleted oldest first until `path` is under `percent`, except on a dry
+    run, which only reports the plan.
+    """
+    usage = psutil.disk_usage(path)
+    bytes_to_free = int(usage.used - (usage.used + usage.free) * percent / 100)
+    typer.echo(f"Need to free {bytes_to_free} bytes on {path}")
+    if bytes_to_free <= 0:
+        return
+
+    sessions = find_stale_sessions(connection, min_days)
+    typer.echo(f"Found {len(sessions)} sessions older than {min_days} days")
+
+    typer.echo(f"Scanning {archive_path} for session sizes")
+    archive = ArchiveUsage(archive_path)
+    archive.scan(scan_workers)
+
+    plan = plan_deletions(
+        sessions,
+        lambda session: archive.session_bytes(session["project"], session["label"]),
+        bytes_to_free,
+    )
+    planned_bytes = sum(subject["size"] for subject in plan)
+    typer.echo(f"Planned deletion of {len(plan)} subjects, {planned_bytes} bytes")
+
+    def under_target() -> bool:
+        return psutil.disk_usage(path).percent <= percent
+
+    processed = delete_subjects(
+        connection, plan, dry_run, workers, path, stop=under_target
+    )
+
+    # A dry run frees nothing, the disk would never get under target
+    if dry_run:
+        typer.echo("Dry run: not deleting beyond the plan")
+    elif not under_target():
+        typer.echo(
+            f"Disk usage for {path} is still {psutil.disk_usage(path).percent}, "
+            "deleting the remaining stale subjects oldest first"
+        )
+        delete_subjects(
+            connection,
+            sorted(sessions, key=lambda session: session["insert_date"]),
+            dry_run,
+            workers,
+            path,
+            processed,
+            stop=under_target,
+        )
+
+
+def remove_stale(
+    connection: pyxnat.Interface,
+    days: int,
+    dry_run: bool = False,
+    workers: int = 1,
+    path: Optional[str] = None,
+):
+    """Removes participant data form an XNAT host that is older
+    than the specified number of days"""
+    typer.echo(f"Searching sessions older than {days} days")
+    to_delete = find_stale_sessions(connection, days)
+
+    typer.echo(f"Found {len(to_delete)} sessions")
+    delete_subjects(connection, to_delete, dry_run, workers, path)
+
+
+def sweep_stale(
+    connection: pyxnat.Interface,
+    path: str,
+    percent: int,
+    sweep: Sequence[int],
+    dry_run: bool = False,
+    workers: int = 1,
+):
+    """
+    Removes subjects older than each number of days in `sweep` in turn,
+    until the usage of `path` is under `percent`
+
+    Stale sessions are queried once for the whole sweep, sorted by insert
+    date, and each subject is deleted at most once.
+    """
+    sessions: Optional[List[dict]] = None
+    position = 0
+    processed: Set[Tuple[str, str]] = set()
+
+    for days in sweep:
+        disk_usage = psutil.disk_usage(path).percent
+        typer.echo(f"Current disk usage for {path} is {disk_usage}")
+        if disk_usage <= percent:
+            break
+
+        if sessions is None:
+            typer.echo(f"Searching sessions older than {min(sweep)} days")
+            sessions = sorted(
+                find_stale_sessions(connection, min(sweep)),
+                key=lambda session: session["insert_date"],
+            )
+            typer.echo(f"Found {len(sessions)} sessions")
+
+        # Sessions that fell in the window since the previous step
+        cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+        start = position
+        while position < len(sessions) and sessions[position]["insert_date"] < cutoff:
+            position += 1
+
+        typer.echo(f"{position - start} more sessions older than {days} days")
+        delete_subjects(
+            connection, sessions[start:position], dry_run, workers, path, processed
+        )
 
 
 @app.command()
@@ -57,27 +301,83 @@ def enforce_disk_usage(
     dry_run: bool = typer.Option(
         False, help="Whether to actually delete or nor the data"
     ),
+    workers: int = typer.Option(1, help="Number of subjects deleted in parallel"),
+    plan: bool = typer.Option(
+        False,
+        help="Delete only the oldest subjects needed to reach the target, "
+        "sized from the archive",
+    ),
+    archive_path: Optional[str] = typer.Option(
+        None, help="XNAT archive root used to size sessions, defaults to PATH"
+    ),
+    scan_workers: int = typer.Option(
+        8, help="Number of sessions sized in parallel when scanning the archive"
+    ),
+    profile: bool = typer.Option(
+        False, help="Print the time spent per endpoint and host at exit"
+    ),
 ):
     """Checks the percent usage of a location,
     then remove stale projects until target percent min_days is hit,
     whichever comes first"""
+    if profile:
+        enable_profile()
 
     xnat_host = os.environ.get("XNAT_RELAY_HOST", "https://xrelay.bnc.brown.edu")
     xnat_user = os.environ.get("XNAT_RELAY_USER", "admin")
     xnat_pass = os.environ.get("XNAT_RELAY_PASS", "")
 
-    connection = pyxnat.Interface(server=xnat_host, user=xnat_user, password=xnat_pass)
+    connection = connect(xnat_host, xnat_user, xnat_pass)
 
-    for days in range(max_days, min_days, step_days):
-        disk_usage = psutil.disk_usage(path).percent
-        typer.echo(f"Current disk usage for {path} is {disk_usage}")
-        if disk_usage > percent:
-            remove_stale(connection, days, dry_run)
-        else:
-            break
+    if plan:
+        remove_planned(
+            connection,
+            path,
+            archive_path or path,
+            percent,
+            min_days,
+            dry_run,
+            workers,
+            scan_workers,
+        )
+    else:
+        sweep_stale(
+            connection,
+            path,
+            percent,
+            range(max_days, min_days, step_days),
+            dry_run,
+            workers,
+        )
 
     connection.disconnect()
 
 
+@app.command()
+def usage(
+    archive_path: str,
+    workers: int = typer.Option(8, help="Number of sessions sized in parallel"),
+    top: int = typer.Option(20, help="Number of largest sessions to list"),
+):
+    """Reports the disk usage of each project and the largest sessions
+    of an XNAT archive"""
+    archive = ArchiveUsage(archive_path)
+    sessions = archive.scan(workers)
+
+    typer.echo(f"{'PROJECT':<30} {'SESSIONS':>8} {'BYTES':>16}")
+    counts: Dict[str, int] = {}
+    for project, _ in sessions:
+        counts[project] = counts.get(project, 0) + 1
+    for project, size in sorted(
+        archive.project_bytes().items(), key=lambda item: item[1], reverse=True
+    ):
+        typer.echo(f"{project:<30} {counts[project]:>8} {size:>16}")
+
+    typer.echo(f"\nLargest {top} sessions")
+    largest = sorted(sessions.items(), key=lambda item: item[1], reverse=True)
+    for (project, session), size in largest[:top]:
+        typer.echo(f"{project + '/' + session:<39} {size:>16}")
+
+
 def main():
     app()
@@ -1,10 +1,106 @@
+import asyncio
+import time
+
 import typer
 
-from xnat_admin_tools.utils.common import fetch_all_projects, set_xsync_credentials
+from xnat_admin_tools.utils.async_common import AsyncXNAT, run_all
+from xnat_admin_tools.utils.cache import host_slug
+from xnat_admin_tools.utils.client import close_clients, get_client
+from xnat_admin_tools.utils.common import (
+    HostCredentials,
+    iter_projects,
+    set_xsync_credentials,
+)
+from xnat_admin_tools.utils.journal import RunJournal
+from xnat_admin_tools.utils.metrics import enable_profile
+from xnat_admin_tools.utils.pool import TaskResult, echo_summary, run_parallel
+from xnat_admin_tools.utils.tokens import get_token_provider
+from xnat_admin_tools.utils.xsync_index import get_xsync_index
 
 app = typer.Typer()
 
 
+def renew_projects(
+    relay: HostCredentials,
+    server: HostCredentials,
+    concurrency: int,
+    report,
+    journal: RunJournal,
+):
+    """Renews every project's credentials through a pool of `concurrency` threads"""
+    xrelay_host, xrelay_user, xrelay_pass = relay
+    xserver_host, xserver_user, xserver_pass = server
+
+    projects = iter_projects(xrelay_host, xrelay_user, xrelay_pass, columns=["ID"])
+    project_ids = [
+        project["ID"] for project in projects if not journal.done(project["ID"])
+    ]
+
+    # Issue the run's token up front, every project reuses it
+    token = get_token_provider(xserver_host, xserver_user, xserver_pass).token()
+    typer.echo(f"Using token {token['alias']} for {len(project_ids)} projects")
+
+    # Fetch xsync configs that changed since the last run, the rest come from cache
+    index = get_xsync_index(xrelay_host, xserver_user, xserver_pass)
+    index.refresh(project_ids, concurrency)
+
+    def renew(project_id: str):
+        response = set_xsync_credentials(
+            xrelay_host,
+            xrelay_user,
+            xrelay_pass,
+            xserver_host,
+            xserver_user,
+            xserver_pass,
+            project_id,
+        )
+        if response.status_code != 200:
+            raise RuntimeError(
+                f"status code {response.status_code}: {response.text.strip()}"
+            )
+
+    return run_parallel(renew, project_ids, concurrency, on_result=report)
+
+
+async def renew_async(
+    relay: HostCredentials,
+    server: HostCredentials,
+    concurrency: int,
+    report,
+    journal: RunJournal,
+):
+    """
+    Renews every project's credentials with up to `concurrency` calls in flight
+    (XNAT_ASYNC_CONCURRENCY if 1), listing the relay's projects while the
+    server issues the token
+    """
+    xrelay_host, xrelay_user, xrelay_pass = relay
+    xserver_host, xserver_user, xserver_pass = server
+    client = AsyncXNAT(concurrency if concurrency > 1 else None)
+
+    project_ids, token = await asyncio.gather(
+        client.project_ids(xrelay_host, xrelay_user, xrelay_pass),
+        client.issue_token(xserver_host, xserver_user, xserver_pass),
+    )
+    project_ids = sorted(
+        project_id for project_id in project_ids if not journal.done(project_id)
+    )
+    typer.echo(f"Using token {token['alias']} for {len(project_ids)} projects")
+
+    await client.refresh_xsync_index(
+        xrelay_host, xserver_user, xserver_pass, project_ids
+    )
+
+    async def renew(project_id: str):
+        response = await client.set_xsync_credentials(*relay, *server, project_id)
+        if response.status_code != 200:
+            raise RuntimeError(
+                f"status code {response.status_code}: {response.text.strip()}"
+            )
+
+    return await run_all(renew, project_ids, on_result=report)
+
+
 # Iterates over all projects, applying updated token
 @app.command()
 def renew_xnat_tokens(
@@ -14,20 +110,66 @@ def renew_xnat_tokens(
     xserver_host: str,
     xserver_user: str,
     xserver_pass: str,
+    concurrency: int = typer.Option(1, help="Number of projects to renew in parallel"),
+    use_async: bool = typer.Option(
+        False, "--async", help="Run the relay and server calls with asyncio"
+    ),
+    resume: bool = typer.Option(
+        False, help="Skip the projects renewed by the last run if it did not finish"
+    ),
+    profile: bool = typer.Option(
+        False, help="Print the time spent per endpoint and host at exit"
+    ),
 ):
-    projects = fetch_all_projects(xrelay_host, xrelay_user, xrelay_pass)
+    if profile:
+        enable_profile()
 
-    for project in projects["ResultSet"]["Result"]:
-        project_id = project["ID"]
-        set_xsync_credentials(
-            xrelay_host,
-            xrelay_user,
-            xrelay_pass,
-            xserver_host,
-            xserver_user,
-            xserver_pass,
-            project_id,
+    if concurrency > 1:
+        # Size the shared connection pools to the number of workers
+        for host, user, password in [
+            (xrelay_host, xrelay_user, xrelay_pass),
+            (xrelay_host, xserver_user, xserver_pass),
+            (xserver_host, xserver_user, xserver_pass),
+        ]:
+            get_client(host, user, password, pool_size=concurrency)
+
+    journal = RunJournal(f"renew-tokens-{host_slug(xrelay_host)}", resume)
+    if journal.resumed:
+        typer.echo(f"Resuming: {len(journal.completed)} projects already renewed")
+
+    def report(result: TaskResult):
+        journal.record(result.item, result.ok, error=result.error)
+        status = "renewed" if result.ok else f"failed ({result.error})"
+        typer.echo(f"{result.item}: {status} in {result.elapsed:.1f}s")
+
+    start = time.monotonic()
+    if use_async:
+        results = asyncio.run(
+            renew_async(
+                (xrelay_host, xrelay_user, xrelay_pass),
+                (xserver_host, xserver_user, xserver_pass),
+                concurrency,
+                report,
+                journal,
+            )
+        )
+    else:
+        results = renew_projects(
+            (xrelay_host, xrelay_user, xrelay_pass),
+            (xserver_host, xserver_user, xserver_pass),
+            concurrency,
+            report,
+            journal,
         )
+    echo_summary(results, time.monotonic() - start, "projects")
+
+    close_clients()
+
+    # Failed projects are retried by the next --resume
+    if not all(result.ok for result in results):
+        journal.close()
+        raise typer.Exit(code=1)
+    journal.finish()
 
 
 def main():
@@ -1,13 +1,29 @@
 import os
+import time
+from typing import Optional
 
-import pyxnat
 import typer
 from dotenv import load_dotenv
 
+from xnat_admin_tools.utils.cache import host_slug
+from xnat_admin_tools.utils.client import close_clients, get_client
 from xnat_admin_tools.utils.common import (
+    connect,
     copy_project_settings,
     create_new_project,
-    fetch_all_projects,
+    fetch_project_snapshots,
+    iter_projects,
+    update_project,
+)
+from xnat_admin_tools.utils.journal import RunJournal
+from xnat_admin_tools.utils.metrics import enable_profile
+from xnat_admin_tools.utils.pool import TaskResult, echo_summary, run_parallel
+from xnat_admin_tools.utils.project_diff import (
+    CREATE,
+    DELETE,
+    ProjectAction,
+    ProjectDiff,
+    project_hash,
 )
 
 load_dotenv()
@@ -16,58 +32,93 @@ app = typer.Typer()
 
 
 @app.command()
-def replicate_projects():
+def replicate_projects(
+    workers: int = typer.Option(
+        1, help="Number of projects replicated in parallel on the QA server"
+    ),
+    state_file: Optional[str] = typer.Option(
+        None, help="Project state from the last run, kept in the cache dir by default"
+    ),
+    resume: bool = typer.Option(
+        False, help="Skip the projects replicated by the last run if it did not finish"
+    ),
+    profile: bool = typer.Option(
+        False, help="Print the time spent per endpoint and host at exit"
+    ),
+):
+    if profile:
+        enable_profile()
+
     prod_xserver_host = os.environ.get("PROD_XNAT_SERVER_HOST", "")
     qa_xserver_host = os.environ.get("QA_XNAT_SERVER_HOST", "")
 
     xserver_user = os.environ.get("XNAT_SERVER_USER", "")
     xserver_pass = os.environ.get("XNAT_SERVER_PASS", "")
 
+    if workers > 1:
+        # Size the shared connection pools to the number of workers
+        for host in (prod_xserver_host, qa_xserver_host):
+            get_client(host, xserver_user, xserver_pass, pool_size=workers)
+
     # Establish connections to source and destination XNAT instances
-    prod_connection = pyxnat.Interface(
-        server=prod_xserver_host, user=xserver_user, password=xserver_pass
-    )
-    qa_connection = pyxnat.Interface(
-        server=qa_xserver_host, user=xserver_user, password=xserver_pass
-    )
+    prod_connection = connect(prod_xserver_host, xserver_user, xserver_pass)
+    qa_connection = connect(qa_xserver_host, xserver_user, xserver_pass)
 
-    # Fetch projects from production and backup relays
-    prod_relay_projects = fetch_all_projects(
-        prod_xserver_host, xserver_user, xserver_pass
+    # All production project values in a single query, QA only needs the IDs
+    snapshots = fetch_project_snapshots(prod_connection)
+    qa_relay_projects = iter_projects(
+        qa_xserver_host, xserver_user, xserver_pass, columns=["ID"]
     )
-    qa_relay_projects = fetch_all_projects(qa_xserver_host, xserver_user, xserver_pass)
+    other_project_ids = {project["ID"] for project in qa_relay_projects}
 
-    # Extract project IDs from project lists
-    my_project_ids = {
-        project["ID"] for project in prod_relay_projects["ResultSet"]["Result"]
-    }
-    other_project_ids = {
-        project["ID"] for project in qa_relay_projects["ResultSet"]["Result"]
-    }
+    # Projects missing on QA or changed on prod since the last run
+    diff = ProjectDiff(prod_xserver_host, qa_xserver_host, state_file)
+    actions = list(diff.actions(snapshots, other_project_ids))
 
-    # Find projects that are in prod but not in backup
-    unique_to_other = my_project_ids - other_project_ids
+    for action in actions:
+        if action.kind == DELETE:
+            typer.echo(f"{action.project_id} is no longer on prod, left as is on QA")
+            diff.record(action)
 
-    print("Projects unique to other relay: ", unique_to_other)
+    actions = [action for action in actions if action.kind != DELETE]
 
-    # # For all projects, fetch from adjacent relay and create on local.
-    for project_id in unique_to_other:
-        try:
+    # Projects replicated before the last run stopped, unless they changed since
+    journal = RunJournal(
+        f"replicate-{host_slug(prod_xserver_host)}--{host_slug(qa_xserver_host)}",
+        resume,
+    )
+    replicated = [
+        action
+        for action in actions
+        if journal.done(action.project_id, project_hash(action.snapshot))
+    ]
+    for action in replicated:
+        diff.record(action)
+    if replicated:
+        typer.echo(f"Resuming: {len(replicated)} projects already replicated")
+    skipped = {action.project_id for action in replicated}
+    actions = [action for action in actions if action.project_id not in skipped]
+    print("Projects to replicate: ", [str(action) for action in actions])
+
+    def replicate(action: ProjectAction):
+        project_id = action.project_id
+        if action.kind == CREATE:
             create_new_project(
                 project_id,
                 prod_connection,
                 qa_connection,
+                action.snapshot,
             )
-        except Exception as e:
-            print("Error: ", e)
-            continue
+        else:
+            update_project(project_id, qa_connection, action.snapshot)
 
         # Copy latest xsync project settings
+        # copy_project_settings reads from its second host, writes to its first
         response = copy_project_settings(
-            prod_xserver_host,
+            qa_xserver_host,
             xserver_user,
             xserver_pass,
-            qa_xserver_host,
+            prod_xserver_host,
             xserver_user,
             xserver_pass,
             project_id,
@@ -76,16 +127,48 @@ def replicate_projects():
         if response.status_code == 200:
             typer.echo(response.text)
         else:
-            typer.echo(
-                """Project settings for {} could not be set.
-                    Please manually set the credentials""".format(
-                    project_id
-                )
+            raise RuntimeError(
+                "project settings could not be set, please set them manually "
+                f"(status code {response.status_code}: {response.text})"
             )
-            print(response.status_code, response.text)
+
+    start = time.monotonic()
+    done = 0
+
+    def report(result: TaskResult):
+        nonlocal done
+        done += 1
+        journal.record(
+            result.item.project_id,
+            result.ok,
+            project_hash(result.item.snapshot),
+            error=result.error,
+        )
+        elapsed = time.monotonic() - start
+        status = "replicated" if result.ok else f"Error: {result.error}"
+        typer.echo(
+            f"[{done}/{len(actions)}] {result.item}: {status} "
+            f"({done / elapsed:.2f} projects/sec)"
+        )
+
+    results = run_parallel(replicate, actions, workers, report)
+    echo_summary(results, time.monotonic() - start, "projects")
+
+    # Failed projects are retried on the next run
+    for result in results:
+        if result.ok:
+            diff.record(result.item)
+    diff.save()
+
+    # Failed projects are retried by the next --resume
+    if all(result.ok for result in results):
+        journal.finish()
+    else:
+        journal.close()
 
     prod_connection.disconnect()
     qa_connection.disconnect()
+    close_clients()
 
 
 def main():
@@ -1,14 +1,29 @@
+import asyncio
 import os
+from typing import Optional
 
 import pyxnat
 import typer
 from dotenv import load_dotenv
 
+from xnat_admin_tools.utils.async_common import AsyncXNAT, run_all
+from xnat_admin_tools.utils.client import close_clients
 from xnat_admin_tools.utils.common import (
+    HostCredentials,
+    connect,
     copy_project_settings,
     create_new_project,
-    fetch_all_projects,
+    fetch_project_snapshots,
+    iter_projects,
     set_xsync_credentials,
+    update_project,
+)
+from xnat_admin_tools.utils.metrics import enable_profile
+from xnat_admin_tools.utils.project_diff import (
+    CREATE,
+    DELETE,
+    ProjectAction,
+    ProjectDiff,
 )
 
 load_dotenv()
@@ -16,8 +31,137 @@ load_dotenv()
 app = typer.Typer()
 
 
+def echo_settings(response, project_id: str) -> bool:
+    if response.status_code == 200:
+        typer.echo(response.text)
+        return True
+
+    typer.echo(
+        """Project settings for {} could not be set.
+            Please manually set the credentials""".format(
+            project_id
+        )
+    )
+    print(response.status_code, response.text)
+    return False
+
+
+def echo_credentials(response, project_id: str) -> bool:
+    if response.status_code == 200:
+        typer.echo(response.text)
+        return True
+
+    typer.echo(
+        """Project credentials for {} could not be set.
+            Please manually set the credentials""".format(
+            project_id
+        )
+    )
+    return False
+
+
+def replicate_action(
+    action: ProjectAction,
+    source_connection: pyxnat.Interface,
+    dest_connection: pyxnat.Interface,
+    relay: HostCredentials,
+    relay2: HostCredentials,
+    server: HostCredentials,
+) -> bool:
+    """
+    Creates or updates a project of the other relay on this one and copies its
+    XSync settings. Returns whether every step succeeded.
+    """
+    project_id = action.project_id
+
+    # projects unique to the other relay are created on this one
+    if action.kind == CREATE:
+        create_new_project(
+            project_id,
+            dest_connection,
+            source_connection,
+            action.snapshot,
+        )
+    else:
+        update_project(project_id, source_connection, action.snapshot)
+
+    # Copy latest xsync project settings
+    response = copy_project_settings(*relay, *relay2, project_id)
+    settings_set = echo_settings(response, project_id)
+
+    # Set up Xsync remote credentials
+    response = set_xsync_credentials(*relay, *server, project_id)
+    credentials_set = echo_credentials(response, project_id)
+
+    return settings_set and credentials_set
+
+
+async def replicate_async(
+    diff: ProjectDiff,
+    source_connection: pyxnat.Interface,
+    dest_connection: pyxnat.Interface,
+    relay: HostCredentials,
+    relay2: HostCredentials,
+    server: HostCredentials,
+):
+    """
+    Same steps as the synchronous run, with both relays queried and the token
+    issued concurrently, and the changed projects replicated concurrently
+    """
+    client = AsyncXNAT()
+
+    snapshots, my_project_ids, _ = await asyncio.gather(
+        client.fetch_project_snapshots(dest_connection),
+        client.project_ids(*relay),
+        client.issue_token(*server),
+    )
+
+    async def replicate(action: ProjectAction) -> bool:
+        project_id = action.project_id
+        if action.kind == CREATE:
+            await client.create_new_project(
+                project_id, dest_connection, source_connection, action.snapshot
+            )
+        else:
+            await client.update_project(project_id, source_connection, action.snapshot)
+
+        response = await client.copy_project_settings(*relay, *relay2, project_id)
+        settings_set = echo_settings(response, project_id)
+        response = await client.set_xsync_credentials(*relay, *server, project_id)
+        return echo_credentials(response, project_id) and settings_set
+
+    actions = []
+    for action in diff.actions(snapshots, my_project_ids):
+        if action.kind == DELETE:
+            typer.echo(
+                f"{action.project_id} is no longer on the other relay, left as is"
+            )
+            diff.record(action)
+        else:
+            actions.append(action)
+
+    for result in await run_all(replicate, actions):
+        if result.ok and result.value:
+            diff.record(result.item)
+        elif not result.ok:
+            typer.echo(f"Replicating {result.item.project_id} failed: {result.error}")
+
+
 @app.command()
-def replicate_projects():
+def replicate_projects(
+    state_file: Optional[str] = typer.Option(
+        None, help="Project state from the last run, kept in the cache dir by default"
+    ),
+    use_async: bool = typer.Option(
+        False, "--async", help="Query both relays and replicate projects concurrently"
+    ),
+    profile: bool = typer.Option(
+        False, help="Print the time spent per endpoint and host at exit"
+    ),
+):
+    if profile:
+        enable_profile()
+
     xrelay_host = os.environ.get("XNAT_RELAY_HOST", "")
     xrelay_user = os.environ.get("XNAT_RELAY_USER", "")
     xrelay_pass = os.environ.get("XNAT_RELAY_PASS", "")
@@ -28,88 +172,52 @@ def replicate_projects():
     xserver_user = os.environ.get("XNAT_SERVER_USER", "")
     xserver_pass = os.environ.get("XNAT_SERVER_PASS", "")
 
-    # Establish connections to source and destination XNAT instances
-    source_connection = pyxnat.Interface(
-        server=xrelay_host, user=xrelay_user, password=xrelay_pass
-    )
-    dest_connection = pyxnat.Interface(
-        server=xrelay2_host, user=xrelay2_user, password=xrelay2_pass
-    )
-
-    # Fetch projects from production and backup relays
-    my_relay_projects = fetch_all_projects(xrelay_host, xrelay_user, xrelay_pass)
-    other_relay_projects = fetch_all_projects(xrelay2_host, xrelay2_user, xrelay2_pass)
+    relay = (xrelay_host, xrelay_user, xrelay_pass)
+    relay2 = (xrelay2_host, xrelay2_user, xrelay2_pass)
+    server = (xserver_host, xserver_user, xserver_pass)
 
-    # Extract project IDs from project lists
-    my_project_ids = {
-        project["ID"] for project in my_relay_projects["ResultSet"]["Result"]
-    }
-    other_project_ids = {
-        project["ID"] for project in other_relay_projects["ResultSet"]["Result"]
-    }
+    # Establish connections to source and destination XNAT instances
+    source_connection = connect(xrelay_host, xrelay_user, xrelay_pass)
+    dest_connection = connect(xrelay2_host, xrelay2_user, xrelay2_pass)
 
-    # Find projects that are in prod but not in backup
-    unique_to_other = other_project_ids - my_project_ids
+    # Projects missing here or changed on the other relay since the last run
+    diff = ProjectDiff(xrelay2_host, xrelay_host, state_file)
 
-    # For all projects, fetch from adjacent relay and create on local.
-    for project_id in unique_to_other:
-        create_new_project(
-            project_id,
-            xrelay2_host,
-            xrelay2_user,
-            xrelay2_pass,
-            xrelay_host,
-            xrelay_user,
-            xrelay_pass,
-            source_connection,
-            dest_connection,
+    if use_async:
+        asyncio.run(
+            replicate_async(
+                diff, source_connection, dest_connection, relay, relay2, server
+            )
         )
-
-        # Copy latest xsync project settings
-        response = copy_project_settings(
-            xrelay_host,
-            xrelay_user,
-            xrelay_pass,
-            xrelay2_host,
-            xrelay2_user,
-            xrelay2_pass,
-            project_id,
+    else:
+        # All of the other relay's project values in a single query,
+        # this relay only needs the IDs
+        snapshots = fetch_project_snapshots(dest_connection)
+        my_relay_projects = iter_projects(
+            xrelay_host, xrelay_user, xrelay_pass, columns=["ID"]
         )
+        my_project_ids = {project["ID"] for project in my_relay_projects}
 
-        if response.status_code == 200:
-            typer.echo(response.text)
-        else:
-            typer.echo(
-                """Project settings for {} could not be set.
-                    Please manually set the credentials""".format(
-                    project_id
+        # For all projects, fetch from adjacent relay and create on local.
+        for action in diff.actions(snapshots, my_project_ids):
+            if action.kind == DELETE:
+                typer.echo(
+                    f"{action.project_id} is no longer on the other relay, left as is"
                 )
-            )
-            print(response.status_code, response.text)
-
-        # Set up Xsync remote credentials
-        response = set_xsync_credentials(
-            xrelay_host,
-            xrelay_user,
-            xrelay_pass,
-            xserver_host,
-            xserver_user,
-            xserver_pass,
-            project_id,
-        )
+                diff.record(action)
+                continue
 
-        if response.status_code == 200:
-            typer.echo(response.text)
-        else:
-            typer.echo(
-                """Project credentials for {} could not be set.
-                    Please manually set the credentials""".format(
-                    project_id
-                )
-            )
+            # Projects whose settings failed are retried on the next run
+            if replicate_action(
+                action, source_connection, dest_connection, relay, relay2, server
+            ):
+                diff.record(action)
+
+    diff.save()
 
     source_connection.disconnect()
     dest_connection.disconnect()
+    close_clients()
 
 
 def main():
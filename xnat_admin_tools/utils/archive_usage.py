@@ -0,0 +1,96 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from xnat_admin_tools.utils.cache import cache_path, host_slug, load_json, save_json
+
+
+class ArchiveUsage:
+    """
+    Byte usage of every session under an XNAT archive
+    (<archive>/<project>/arc001/<session>)
+
+    Sessions are walked in parallel with os.scandir. The bytes held directly
+    by each directory are cached together with the directory mtime, so a
+    rescan only stats the files of directories that changed since.
+    """
+
+    def __init__(self, archive_path: str, cache_file: Optional[str] = None):
+        self.archive_path = os.path.abspath(archive_path)
+        self.cache_file = cache_file or cache_path(
+            f"archive-usage-{host_slug(self.archive_path)}.json"
+        )
+        self._cached: Dict[str, List[int]] = load_json(self.cache_file, {})
+        self._scanned: Dict[str, List[int]] = {}
+        self.sessions: Dict[Tuple[str, str], int] = {}
+
+    def _session_dirs(self) -> List[Tuple[str, str, str]]:
+        session_dirs = []
+        with os.scandir(self.archive_path) as projects:
+            for project in projects:
+                arc_dir = os.path.join(project.path, "arc001")
+                if not project.is_dir(follow_symlinks=False) or not os.path.isdir(
+                    arc_dir
+                ):
+                    continue
+                with os.scandir(arc_dir) as sessions:
+                    for session in sessions:
+                        if session.is_dir(follow_symlinks=False):
+                            session_dirs.append(
+                                (project.name, session.name, session.path)
+                            )
+        return session_dirs
+
+    def _dir_bytes(self, path: str) -> int:
+        """Bytes under `path`, reusing cached totals of unchanged directories"""
+        mtime = os.stat(path).st_mtime_ns
+        cached = self._cached.get(path)
+        unchanged = cached is not None and cached[0] == mtime
+
+        files_bytes = 0
+        subdirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.path)
+                elif not unchanged:
+                    files_bytes += entry.stat(follow_symlinks=False).st_size
+
+        if unchanged and cached is not None:
+            files_bytes = cached[1]
+        self._scanned[path] = [mtime, files_bytes]
+
+        return files_bytes + sum(self._dir_bytes(subdir) for subdir in subdirs)
+
+    def scan(self, workers: int = 8) -> Dict[Tuple[str, str], int]:
+        """Scan the archive, returning {(project, session): bytes}"""
+        session_dirs = self._session_dirs()
+        self._scanned = {}
+
+        def measure(session_dir: Tuple[str, str, str]) -> int:
+            try:
+                return self._dir_bytes(session_dir[2])
+            except OSError:
+                # session removed while scanning
+                return 0
+
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            sizes = executor.map(measure, session_dirs)
+            self.sessions = {
+                (project, session): size
+                for (project, session, _), size in zip(session_dirs, sizes)
+            }
+
+        self._cached = self._scanned
+        save_json(self.cache_file, self._cached)
+        return self.sessions
+
+    def session_bytes(self, project: str, session: str) -> int:
+        return self.sessions.get((project, session), 0)
+
+    def project_bytes(self) -> Dict[str, int]:
+        """Total bytes per project"""
+        totals: Dict[str, int] = {}
+        for (project, _), size in self.sessions.items():
+            totals[project] = totals.get(project, 0) + size
+        return totals
@@ -0,0 +1,107 @@
+import asyncio
+import os
+import time
+from typing import Any, Awaitable, Callable, Iterable, List, Optional, Set
+
+from xnat_admin_tools.utils import common
+from xnat_admin_tools.utils.pool import TaskResult
+from xnat_admin_tools.utils.tokens import get_token_provider
+from xnat_admin_tools.utils.xsync_index import get_xsync_index
+
+
+class AsyncXNAT:
+    """
+    asyncio front end to the operations of utils.common
+
+    Every call runs the blocking helper in a worker thread, reusing the pooled
+    per-host clients and pyxnat connections, so independent calls to the
+    relays and the server can be awaited together. At most `concurrency`
+    calls (XNAT_ASYNC_CONCURRENCY, 10 by default) are in flight at once.
+    """
+
+    def __init__(self, concurrency: Optional[int] = None):
+        self.concurrency = concurrency or int(
+            os.environ.get("XNAT_ASYNC_CONCURRENCY", "10")
+        )
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+
+    async def run(self, func: Callable, *args, **kwargs) -> Any:
+        async with self._semaphore:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def fetch_project_snapshots(self, src_conn, project_ids=None) -> dict:
+        return await self.run(common.fetch_project_snapshots, src_conn, project_ids)
+
+    async def project_ids(self, host: str, user: str, password: str) -> Set[str]:
+        """IDs of every project on a host"""
+
+        def fetch():
+            projects = common.iter_projects(host, user, password, columns=["ID"])
+            return {project["ID"] for project in projects}
+
+        return await self.run(fetch)
+
+    async def issue_token(self, host: str, user: str, password: str) -> dict:
+        return await self.run(get_token_provider(host, user, password).token)
+
+    async def refresh_xsync_index(
+        self, host: str, user: str, password: str, project_ids: Iterable[str]
+    ):
+        index = get_xsync_index(host, user, password)
+        return await self.run(index.refresh, list(project_ids), self.concurrency)
+
+    async def create_new_project(self, project_id, src_conn, dst_conn, snapshot=None):
+        return await self.run(
+            common.create_new_project, project_id, src_conn, dst_conn, snapshot
+        )
+
+    async def update_project(self, project_id, dst_conn, snapshot):
+        return await self.run(common.update_project, project_id, dst_conn, snapshot)
+
+    async def add_users_as_owners(
+        self, project, project_id, src_conn, dst_conn, snapshot=None
+    ):
+        return await self.run(
+            common.add_users_as_owners,
+            project,
+            project_id,
+            src_conn,
+            dst_conn,
+            snapshot,
+        )
+
+    async def set_xsync_credentials(self, *args):
+        return await self.run(common.set_xsync_credentials, *args)
+
+    async def set_project_settings(self, *args):
+        return await self.run(common.set_project_settings, *args)
+
+    async def copy_project_settings(self, *args):
+        return await self.run(common.copy_project_settings, *args)
+
+
+async def run_all(
+    func: Callable[[Any], Awaitable[Any]],
+    items: Iterable[Any],
+    on_result: Optional[Callable[[TaskResult], None]] = None,
+) -> List[TaskResult]:
+    """
+    Await func(item) for every item concurrently, the asyncio counterpart of
+    pool.run_parallel. Exceptions are captured per item and `on_result` is
+    called as each item completes.
+    """
+
+    async def run_one(item: Any) -> TaskResult:
+        start = time.monotonic()
+        try:
+            value = await func(item)
+            result = TaskResult(item, True, value, elapsed=time.monotonic() - start)
+        except Exception as e:
+            result = TaskResult(
+                item, False, error=str(e), elapsed=time.monotonic() - start
+            )
+        if on_result:
+            on_result(result)
+        return result
+
+    return list(await asyncio.gather(*(run_one(item) for item in items)))
@@ -0,0 +1,39 @@
+import json
+import os
+import re
+from typing import Any
+
+
+def cache_path(name: str) -> str:
+    """
+    Path of a file in the local cache directory (XNAT_ADMIN_CACHE_DIR,
+    ~/.cache/xnat-admin-tools by default), creating the directory if needed
+    """
+    cache_dir = os.environ.get(
+        "XNAT_ADMIN_CACHE_DIR",
+        os.path.join(os.path.expanduser("~"), ".cache", "xnat-admin-tools"),
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, name)
+
+
+def host_slug(host: str) -> str:
+    """Filesystem friendly name for a host url"""
+    return re.sub(r"[^A-Za-z0-9.-]+", "_", re.sub(r"^https?://", "", host)).strip("_")
+
+
+def load_json(path: str, default: Any = None) -> Any:
+    """Load a JSON file, returning `default` if it is missing or unreadable"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(path: str, data: Any):
+    """Atomically write `data` as JSON to `path`"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
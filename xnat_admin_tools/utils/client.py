@@ -0,0 +1,186 @@
+import functools
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+from xnat_admin_tools.utils.metrics import timed
+
+# XNAT answers 423 while a resource is locked (e.g. during an xsync transfer)
+RETRY_STATUSES = (423, 500, 502, 503, 504)
+
+
+class XNATClient:
+    """
+    Pooled HTTP client for a single XNAT host
+
+    Connections are kept alive and shared across calls (and threads). The first
+    request authenticates against /data/JSESSION with basic auth; after that the
+    JSESSIONID cookie is reused, falling back to basic auth if the session expires.
+    If the server does not hand out a JSESSION, the client sticks to basic auth
+    rather than asking again on every request. Requests answered with 423/5xx
+    are retried with exponential backoff. Every request is timed in utils.metrics.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        pool_size: Optional[int] = None,
+        timeout: Optional[float] = None,
+        retries: Optional[int] = None,
+        backoff_factor: Optional[float] = None,
+    ):
+        self.host = host.rstrip("/")
+        self.user = user
+        self.timeout = (
+            timeout
+            if timeout is not None
+            else float(os.environ.get("XNAT_HTTP_TIMEOUT", "60"))
+        )
+        pool_size = pool_size or int(os.environ.get("XNAT_HTTP_POOL_SIZE", "10"))
+        retries = (
+            retries
+            if retries is not None
+            else int(os.environ.get("XNAT_HTTP_RETRIES", "3"))
+        )
+        backoff_factor = (
+            backoff_factor
+            if backoff_factor is not None
+            else float(os.environ.get("XNAT_HTTP_BACKOFF", "0.5"))
+        )
+
+        self._basic = HTTPBasicAuth(user, password)
+        self._lock = threading.Lock()
+        self._authenticated = False
+        self._session_failed = False
+
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=None,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=retry,
+            pool_block=True,
+        )
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _url(self, path: str) -> str:
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return self.host + path
+
+    def _authenticate(self):
+        """
+        Open a JSESSION on the server, the cookie is kept by the session. A
+        failed attempt is remembered so later requests use basic auth instead.
+        """
+        try:
+            response = self.session.post(
+                self._url("/data/JSESSION"), auth=self._basic, timeout=self.timeout
+            )
+            self._authenticated = response.status_code == 200
+        except requests.exceptions.RequestException:
+            self._authenticated = False
+        self._session_failed = not self._authenticated
+
+    def _auth(self):
+        return None if self._authenticated else self._basic
+
+    def request(self, method: str, path: str, **kwargs) -> requests.Response:
+        """
+        Issue a request against the host. `path` may be relative to the host
+        or a full URL. Keyword arguments are passed on to requests.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        url = self._url(path)
+
+        with timed("http", method, url) as call:
+            if not self._authenticated and not self._session_failed:
+                with self._lock:
+                    if not self._authenticated and not self._session_failed:
+                        self._authenticate()
+
+            auth = self._auth()
+            response = self.session.request(method, url, auth=auth, **kwargs)
+
+            if response.status_code == 401 and auth is None:
+                # JSESSION expired, re-authenticate once and replay the request
+                with self._lock:
+                    self._authenticate()
+                response = self.session.request(
+                    method, url, auth=self._auth(), **kwargs
+                )
+
+            call["error"] = response.status_code >= 400
+
+        return response
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def close(self):
+        """Invalidate the JSESSION on the server and release pooled connections"""
+        if self._authenticated:
+            try:
+                self.session.delete(self._url("/data/JSESSION"), timeout=self.timeout)
+            except requests.exceptions.RequestException:
+                pass
+            self._authenticated = False
+        self.session.close()
+
+
+_clients: Dict[Tuple[str, str], XNATClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(host: str, user: str, password: str, **kwargs) -> XNATClient:
+    """
+    Return the shared client for (host, user), creating it on first use.
+    Keyword arguments (pool_size, timeout, retries, backoff_factor) only
+    apply when the client is created.
+    """
+    key = (host.rstrip("/"), user)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = XNATClient(host, user, password, **kwargs)
+        return _clients[key]
+
+
+def close_clients():
+    """Close every shared client, ending their sessions on the servers"""
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def closing_clients(func):
+    """
+    Closes the shared clients once `func` returns, for RQ jobs: the default
+    worker forks a process per job that exits without ending its sessions
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_clients()
+
+    return wrapper
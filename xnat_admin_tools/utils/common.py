@@ -1,32 +1,98 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, Optional, Sequence, Tuple
+
 import pyxnat
-import requests
 import typer
-from requests.auth import HTTPBasicAuth
 
+from xnat_admin_tools.utils.client import get_client
+from xnat_admin_tools.utils.metrics import instrument_pyxnat
+from xnat_admin_tools.utils.tokens import get_token_provider
+from xnat_admin_tools.utils.xsync_index import get_xsync_index, invalidate_project
+
+# (host, user, password) of an XNAT instance
+HostCredentials = Tuple[str, str, str]
+
+# Fields used to create a project, in the order remove_empty expects them
+PROJECT_FIELDS = [
+    "xnat:projectData/ID",
+    "xnat:projectData/NAME",
+    "xnat:projectData/SECONDARY_ID",
+    "xnat:projectData/PI",
+    "xnat:projectData/DESCRIPTION",
+]
+
+SNAPSHOT_FIELDS = PROJECT_FIELDS + [
+    "xnat:projectData/PROJECT_ACCESS",
+    "xnat:projectData/PROJECT_INVS",
+]
+
+
+def connect(host: str, user: str, password: str) -> pyxnat.Interface:
+    """pyxnat connection to a host, with its REST calls timed in utils.metrics"""
+    return instrument_pyxnat(
+        pyxnat.Interface(server=host, user=user, password=password)
+    )
+
+
+def fetch_project_snapshots(
+    src_conn: pyxnat.Interface, project_ids: Optional[Iterable[str]] = None
+) -> Dict[str, dict]:
+    """
+    Fetch everything needed to replicate a list of projects in one search query
+    Input:
+        src_conn: Instantiated pyxnat.Interface class of the source server
+        project_ids: IDs of the projects to fetch, all projects if None
+    Returns:
+        snapshots: Dictionary of project ID to the selected values, keyed by
+                   lowercase field name e.g. {"id": ..., "project_access": ...}
+    """
+    search = src_conn.select("xnat:projectData", SNAPSHOT_FIELDS)
+
+    if project_ids is None:
+        # The API returns a list of dictionary elements of all values selected
+        rows = search.all().data
+    else:
+        project_ids = list(project_ids)
+        if not project_ids:
+            return {}
+
+        constraints: list = [("xnat:projectData/ID", "=", pid) for pid in project_ids]
+        if len(constraints) > 1:
+            constraints.append("OR")
+        rows = search.where(constraints).data
 
-def add_users_as_owners(project, project_id, src_conn, dst_conn):
+    return {row["id"]: row for row in rows}
+
+
+def snapshot_values(snapshot: dict) -> dict:
+    """Values of PROJECT_FIELDS in a project snapshot, ready for remove_empty"""
+    return {field: snapshot[field.split("/")[-1].lower()] for field in PROJECT_FIELDS}
+
+
+def add_users_as_owners(
+    project, project_id, src_conn, dst_conn, snapshot: Optional[dict] = None
+):
     """
     Add users as owners to the specified project.
 
     :param project: The project object to which users will be added
-    :param user_details: Dictionary of user details
-    :param users: List of users to be added
+    :param project_id: ID of the project on the source server
+    :param snapshot: Project values from fetch_project_snapshots, fetched if not given
     """
 
     # The PI are added as project investigators
-    # users contains is a list of PI + project investigatos of the project
-    # The API returns a list of dict(zip("project_invs",
-    #               "PI(lastname, firstname) <br/>
-    #                investigator 1(lastname, firstname) <br/>
-    #                investigator 2(lastname, firstname) ..."))
-    users = (
-        src_conn.select(
-            "xnat:projectData",
-            ["xnat:projectData/PROJECT_INVS"],
-        )
-        .where([("xnat:projectData/ID", "=", project_id)])
-        .data
-    )
+    # project_invs contains the PI + project investigatos of the project
+    # "PI(lastname, firstname) <br/>
+    #  investigator 1(lastname, firstname) <br/>
+    #  investigator 2(lastname, firstname) ..."
+    if snapshot is None:
+        snapshot = fetch_project_snapshots(src_conn, [project_id]).get(project_id, {})
+
+    investigators = (snapshot.get("project_invs") or "").split("<br/>")
+    users = [user.strip() for user in investigators if user.strip()]
 
     user_details = get_user_details(dst_conn)
 
@@ -43,65 +109,62 @@ def create_new_project(
     project_id: str,
     src_conn,
     dst_conn,
+    snapshot: Optional[dict] = None,
 ):
     """
     Create a project on destination server with the same settings as on the source server
 
     This function creates a project on a destination XNAT server with the same
     settings as on the source server. Investigators are added as users.
+    Pass a snapshot from fetch_project_snapshots to skip querying the source server.
     """
 
     typer.echo(f"Creating project {project_id} on destination XNAT server")
 
     typer.echo("Retrieved source and destination connections")
 
-    values_to_select = [
-        "xnat:projectData/ID",
-        "xnat:projectData/NAME",
-        "xnat:projectData/SECONDARY_ID",
-        "xnat:projectData/PI",
-        "xnat:projectData/DESCRIPTION",
-    ]
-
-    # The API returns a list of dictionary elements of all values selected
-    project_values = (
-        src_conn.select(
-            "xnat:projectData",
-            values_to_select,
-        )
-        .where([("xnat:projectData/ID", "=", project_id)])
-        .data
-    )
+    if snapshot is None:
+        snapshot = fetch_project_snapshots(src_conn, [project_id]).get(project_id)
 
-    typer.echo("Found project with project details {}".format(project_values[0]))
+    server_project = dst_conn.select.project(project_id)
 
-    accessibility = (
-        src_conn.select(
-            "xnat:projectData",
-            ["xnat:projectData/PROJECT_ACCESS"],
-        )
-        .where([("xnat:projectData/ID", "=", project_id)])
-        .data
-    )
+    if snapshot is None:
+        typer.echo("Project with {} not found".format(project_id))
+        return server_project
 
-    try:
-        values_to_insert = remove_empty(values_to_select, project_values[0])
-        typer.echo("Creating project on server")
-        server_project = dst_conn.select.project(project_id)
+    typer.echo("Found project with project details {}".format(snapshot))
 
-        if not (server_project.exists()):
-            server_project.create(**values_to_insert)
-            typer.echo("Project {} created".format(project_id))
-            typer.echo("Project created with values {}".format(values_to_insert))
+    values_to_insert = remove_empty(PROJECT_FIELDS, snapshot_values(snapshot))
+    typer.echo("Creating project on server")
 
-            server_project.set_accessibility(
-                accessibility=accessibility[0]["project_access"]
-            )
+    if not (server_project.exists()):
+        server_project.create(**values_to_insert)
+        typer.echo("Project {} created".format(project_id))
+        typer.echo("Project created with values {}".format(values_to_insert))
+
+        server_project.set_accessibility(accessibility=snapshot["project_access"])
+
+    else:
+        typer.echo("{} project already exists on server".format(project_id))
+
+    return server_project
 
-        else:
-            typer.echo("{} project already exists on server".format(project_id))
-    except IndexError:
-        typer.echo("Project with {} not found".format(project_id))
+
+def update_project(project_id: str, dst_conn, snapshot: dict):
+    """
+    Update an existing project on the destination server to match a snapshot
+    of the source project (name, secondary ID, PI, description, accessibility)
+    """
+    typer.echo(f"Updating project {project_id} on destination XNAT server")
+
+    server_project = dst_conn.select.project(project_id)
+
+    values_to_update = remove_empty(PROJECT_FIELDS, snapshot_values(snapshot))
+    values_to_update.pop("xnat:projectData/ID", None)
+    server_project.attrs.mset(values_to_update)
+    server_project.set_accessibility(accessibility=snapshot["project_access"])
+
+    typer.echo("Project updated with values {}".format(values_to_update))
 
     return server_project
 
@@ -127,53 +190,210 @@ def remove_empty(values_to_select, project_values):
     return values_to_insert
 
 
-def fetch_all_sessions(xserver_host, xserver_user, xserver_pass, project_id):
+def fetch_all_sessions(
+    xserver_host,
+    xserver_user,
+    xserver_pass,
+    project_id,
+    columns: Optional[Sequence[str]] = None,
+):
     # GET all sessions for a project from xnat remote server
-    basic = HTTPBasicAuth(xserver_user, xserver_pass)
+    client = get_client(xserver_host, xserver_user, xserver_pass)
     get_url = xserver_host + "/data/projects/" + project_id + "/experiments"
     print(get_url)
-    response = requests.request(
-        "GET",
+    response = client.get(
         get_url,
         headers={"Content-Type": "application/json"},
-        auth=basic,
+        params=_columns_param(columns),
     )
     print("Response: ", response)
     return response.json()
 
 
-def fetch_all_projects(xserver_host, xserver_user, xserver_pass):
+def fetch_all_projects(
+    xserver_host, xserver_user, xserver_pass, columns: Optional[Sequence[str]] = None
+):
     # GET all projects from xnat remote server
-    basic = HTTPBasicAuth(xserver_user, xserver_pass)
+    client = get_client(xserver_host, xserver_user, xserver_pass)
     get_url = xserver_host + "/data/projects"
     print(get_url)
-    response = requests.request(
-        "GET",
+    response = client.get(
         get_url,
         headers={"Content-Type": "application/json"},
-        auth=basic,
+        params=_columns_param(columns),
     )
     print("Response: ", response)
     return response.json()
 
 
-def get_user_details(connection: pyxnat.Interface):
+def _columns_param(columns: Optional[Sequence[str]]) -> dict:
+    """Query parameters asking XNAT to only return the given columns"""
+    return {"columns": ",".join(columns)} if columns else {}
+
+
+def iter_result_set(
+    response, columns: Optional[Sequence[str]] = None
+) -> Iterator[dict]:
+    """
+    Yield the ResultSet.Result rows of a streamed XNAT listing one at a time
+    Input:
+        response: requests.Response opened with stream=True
+        columns: Keys to keep in each row, all keys if None
+    Rows are parsed incrementally when ijson is installed, otherwise the body
+    is loaded at once.
+    """
+    try:
+        import ijson
+    except ImportError:
+        ijson = None  # type: ignore
+
+    try:
+        response.raise_for_status()
+        if ijson is None:
+            rows = iter(response.json()["ResultSet"]["Result"])
+        else:
+            response.raw.decode_content = True
+            rows = ijson.items(response.raw, "ResultSet.Result.item")
+
+        for row in rows:
+            yield {c: row.get(c) for c in columns} if columns else row
+    finally:
+        response.close()
+
+
+def iter_listing(
+    client,
+    get_url: str,
+    columns: Optional[Sequence[str]] = None,
+    page_size: Optional[int] = None,
+    workers: int = 1,
+) -> Iterator[dict]:
+    """
+    Yield the rows of an XNAT listing, restricted server side to `columns`
+    Input:
+        client: XNATClient of the host
+        get_url: URL of the listing e.g. {host}/data/projects
+        columns: Columns to return, all columns if None
+        page_size: Rows per request (limit/offset), a single streamed request if None
+        workers: Pages fetched in parallel once the total is known
+    """
+    headers = {"Content-Type": "application/json"}
+    params = _columns_param(columns)
+
+    if not page_size:
+        response = client.get(get_url, headers=headers, params=params, stream=True)
+        yield from iter_result_set(response, columns)
+        return
+
+    def fetch_page(offset: int) -> Tuple[list, int]:
+        R = client.get(
+            get_url,
+            headers=headers,
+            params=dict(params, limit=page_size, offset=offset),
+        )
+        R.raise_for_status()
+        result_set = R.json()["ResultSet"]
+        rows = result_set["Result"]
+        if columns:
+            rows = [{c: row.get(c) for c in columns} for row in rows]
+        return rows, int(result_set.get("totalRecords") or 0)
+
+    rows, total = fetch_page(0)
+    yield from rows
+
+    # A short page is the last one. A longer one means paging was ignored.
+    if len(rows) != page_size:
+        return
+
+    # totalRecords may only count the rows of the page, so it is just a hint
+    # of how many pages to fetch in parallel. The listing ends on a short page.
+    offset = page_size
+    if workers > 1 and total > page_size:
+        offsets = range(page_size, total, page_size)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for rows, _ in executor.map(fetch_page, offsets):
+                yield from rows
+        if len(rows) < page_size:
+            return
+        offset = offsets[-1] + page_size
+
+    while True:
+        rows, _ = fetch_page(offset)
+        yield from rows
+        if len(rows) < page_size:
+            break
+        offset += page_size
+
+
+def iter_sessions(
+    xserver_host,
+    xserver_user,
+    xserver_pass,
+    project_id,
+    columns: Optional[Sequence[str]] = None,
+    page_size: Optional[int] = None,
+    workers: int = 1,
+) -> Iterator[dict]:
+    # Iterate over all sessions for a project from xnat remote server
+    client = get_client(xserver_host, xserver_user, xserver_pass)
+    get_url = xserver_host + "/data/projects/" + project_id + "/experiments"
+    return iter_listing(client, get_url, columns, page_size, workers)
+
+
+def iter_projects(
+    xserver_host,
+    xserver_user,
+    xserver_pass,
+    columns: Optional[Sequence[str]] = None,
+    page_size: Optional[int] = None,
+    workers: int = 1,
+) -> Iterator[dict]:
+    # Iterate over all projects from xnat remote server
+    client = get_client(xserver_host, xserver_user, xserver_pass)
+    get_url = xserver_host + "/data/projects"
+    return iter_listing(client, get_url, columns, page_size, workers)
+
+
+# server -> (time of lookup, user details), see get_user_details
+_user_details_cache: Dict[str, Tuple[float, dict]] = {}
+
+
+def get_user_details(connection: pyxnat.Interface, ttl: Optional[float] = None):
     """
     Get the details for all users on the server
     Input:
         connection: Instantiated pyxnat.Interface class
+        ttl: Seconds the lookup is reused for the same server within this process
+             (XNAT_USER_INDEX_TTL, 600 by default)
     Returns:
         user_details: Dictionary with userid associated for all users on the server
                       e.g. {"lastname, firstname": userid}
     """
-
-    users = connection.manage.users()
-    users_details = {}
-    for user in users:
-        firstname = connection.manage.users.firstname(user)
-        lastname = connection.manage.users.lastname(user)
-        users_details["{}, {}".format(lastname, firstname)] = user
-
+    if ttl is None:
+        ttl = float(os.environ.get("XNAT_USER_INDEX_TTL", "600"))
+
+    server = connection._server
+    cached = _user_details_cache.get(server)
+    if cached and time.monotonic() - cached[0] < ttl:
+        return cached[1]
+
+    # All profiles in a single request
+    response = connection.get("/xapi/users/profiles")
+    if response.status_code == 200:
+        users_details = {}
+        for profile in response.json():
+            name = "{}, {}".format(profile["lastName"], profile["firstName"])
+            users_details[name] = profile["username"]
+    else:
+        # Older servers without the profiles API, 2 requests per user
+        users = connection.manage.users()
+        users_details = {}
+        for user in users:
+            firstname = connection.manage.users.firstname(user)
+            lastname = connection.manage.users.lastname(user)
+            users_details["{}, {}".format(lastname, firstname)] = user
+
+    _user_details_cache[server] = (time.monotonic(), users_details)
     return users_details
 
 
@@ -189,23 +409,13 @@ def set_xsync_credentials(
     """
     Sets remote server credentials for Xsync service on the relay
 
+    The alias token is issued once per process and reused for every project
+    until shortly before it expires (see XNAT_TOKEN_REFRESH_MARGIN).
     If this step fails please set credentials manually
     """
-    import json
 
-    import requests
-    from requests.auth import HTTPBasicAuth
-
-    # get token from xnat remote server
-    basic = HTTPBasicAuth(xserver_user, xserver_pass)
-    get_url = xserver_host + "/data/services/tokens/issue"
-    R = requests.request(
-        "GET",
-        get_url,
-        headers={"Content-Type": "application/json"},
-        auth=basic,
-    )
-    response = R.json()
+    # get token from xnat remote server, shared by all projects in this run
+    response = get_token_provider(xserver_host, xserver_user, xserver_pass).token()
 
     alias, secret, expiration = (
         response["alias"],
@@ -213,23 +423,12 @@ def set_xsync_credentials(
         response["estimatedExpirationTime"],
     )
 
-    get_url = xrelay_host + f"/data/projects/{project_id}/config/xsync"
-    R = requests.request(
-        "GET",
-        get_url,
-        headers={"Content-Type": "application/json"},
-        auth=basic,
-    )
-
-    response = R.json()
-
-    # XNAT stores all prior versions of XSync configs per project. Fetching the latest (-1 index).
-    xsync_config = response["ResultSet"]["Result"][-1]["contents"]
-    content_dict = json.loads(xsync_config)
-    remote_project_id = content_dict["remote_project_id"]
+    # remote project id from the latest xsync config, cached across runs
+    index = get_xsync_index(xrelay_host, xserver_user, xserver_pass)
+    remote_project_id = index.remote_project_id(project_id)
 
     # make the post call to xsync on relay
-    basic = HTTPBasicAuth(xrelay_user, xrelay_pass)
+    relay = get_client(xrelay_host, xrelay_user, xrelay_pass)
     payload = {
         "username": xserver_user,
         "secret": secret,
@@ -242,12 +441,10 @@ def set_xsync_credentials(
 
     post_url = xrelay_host + "/xapi/xsync/credentials/save/projects/" + project_id
 
-    R = requests.request(
-        "POST",
+    R = relay.post(
         post_url,
         headers={"Content-Type": "text/plain"},
         data=json.dumps(payload),
-        auth=basic,
     )
 
     return R
@@ -265,12 +462,7 @@ def set_project_settings(
 
     If this step fails please set the project settings manually
     """
-    import json
-
-    import requests
-    from requests.auth import HTTPBasicAuth
-
-    basic = HTTPBasicAuth(xrelay_user, xrelay_pass)
+    relay = get_client(xrelay_host, xrelay_user, xrelay_pass)
     payload = {
         "project_resources": {"sync_type": "none"},
         "subject_resources": {"sync_type": "none"},
@@ -290,14 +482,15 @@ def set_project_settings(
     }
 
     post_url = xrelay_host + "/xapi/xsync/setup/projects/" + project_id
-    R = requests.request(
-        "POST",
+    R = relay.post(
         post_url,
         headers={"Content-Type": "text/plain"},
         data=json.dumps(payload),
-        auth=basic,
     )
 
+    if R.status_code == 200:
+        invalidate_project(xrelay_host, project_id)
+
     return R
 
 
@@ -311,37 +504,28 @@ def copy_project_settings(
     project_id: str,
 ):
     """
-    Sets project settings for the project on the relay
+    Copies the project settings of the project on relay2 to the relay
 
     If this step fails please set the project settings manually
     """
-    import json
-
-    import requests
-    from requests.auth import HTTPBasicAuth
-
-    basic = HTTPBasicAuth(xrelay2_user, xrelay2_pass)
+    relay2 = get_client(xrelay2_host, xrelay2_user, xrelay2_pass)
     get_url = xrelay2_host + "/xapi/xsync/setup/projects/" + project_id
-    R = requests.request(
-        "GET",
-        get_url,
-        headers={"Content-Type": "text/plain"},
-        auth=basic,
-    )
+    R = relay2.get(get_url, headers={"Content-Type": "text/plain"})
 
     print("GET Response: ", R.json())
     payload = R.json()
 
-    basic = HTTPBasicAuth(xrelay_user, xrelay_pass)
+    relay = get_client(xrelay_host, xrelay_user, xrelay_pass)
     post_url = xrelay_host + "/xapi/xsync/setup/projects/" + project_id
 
     print("POST URL: ", post_url)
-    R = requests.request(
-        "POST",
+    R = relay.post(
         post_url,
         headers={"Content-Type": "text/plain"},
         data=json.dumps(payload),
-        auth=basic,
     )
 
+    if R.status_code == 200:
+        invalidate_project(xrelay_host, project_id)
+
     return R
@@ -0,0 +1,102 @@
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from rq import Queue
+from rq.job import Job
+
+from xnat_admin_tools.utils.pool import TaskResult
+
+FINAL_STATUSES = ("finished", "failed", "stopped", "canceled")
+
+
+def get_fanout_queue(connection) -> Queue:
+    """Queue of the fanned out admin tasks (XNAT_FANOUT_QUEUE, xnat-admin)"""
+    return Queue(
+        os.environ.get("XNAT_FANOUT_QUEUE", "xnat-admin"), connection=connection
+    )
+
+
+def enqueue_tasks(
+    queue: Queue,
+    func: Callable,
+    tasks: Sequence[Tuple[Any, tuple]],
+    job_timeout: int = 1800,
+    batch_size: int = 100,
+) -> Dict[str, Any]:
+    """
+    Enqueues func(*args) for every (item, args) of `tasks` in pipelined
+    batches. Returns {job_id: item}.
+    """
+    jobs: Dict[str, Any] = {}
+    for start in range(0, len(tasks), batch_size):
+        end = start + batch_size
+        batch = tasks[start:end]
+        enqueued = queue.enqueue_many(
+            [
+                Queue.prepare_data(
+                    func,
+                    args=args,
+                    timeout=job_timeout,
+                    result_ttl=86400,
+                    description=f"{func.__name__} {item}",
+                )
+                for item, args in batch
+            ]
+        )
+        jobs.update((job.id, item) for job, (item, _) in zip(enqueued, batch))
+    return jobs
+
+
+def _task_result(item: Any, job: Optional[Job]) -> TaskResult:
+    if job is None:
+        return TaskResult(item, False, error="job expired")
+
+    elapsed = (
+        (job.ended_at - job.started_at).total_seconds()
+        if job.ended_at and job.started_at
+        else 0.0
+    )
+    if job.get_status(refresh=False) == "finished":
+        return TaskResult(item, True, job.result, elapsed=elapsed)
+
+    error = (job.exc_info or job.get_status(refresh=False)).strip().splitlines()[-1]
+    return TaskResult(item, False, error=error, elapsed=elapsed)
+
+
+def wait_for_jobs(
+    connection,
+    jobs: Dict[str, Any],
+    poll: float = 2.0,
+    timeout: Optional[float] = None,
+    on_result: Optional[Callable[[TaskResult], None]] = None,
+) -> List[TaskResult]:
+    """
+    Polls the jobs until they all ended (or `timeout` seconds passed) and
+    returns their outcomes as TaskResults. Each poll fetches the pending jobs
+    in a single pipelined round trip.
+    """
+    pending = dict(jobs)
+    results = []
+    start = time.monotonic()
+
+    while pending:
+        job_ids = list(pending)
+        for job_id, job in zip(job_ids, Job.fetch_many(job_ids, connection)):
+            if job is None or job.get_status(refresh=False) in FINAL_STATUSES:
+                result = _task_result(pending.pop(job_id), job)
+                if on_result:
+                    on_result(result)
+                results.append(result)
+
+        if not pending:
+            break
+        if timeout is not None and time.monotonic() - start > timeout:
+            results.extend(
+                TaskResult(item, False, error="still running")
+                for item in pending.values()
+            )
+            break
+        time.sleep(poll)
+
+    return results
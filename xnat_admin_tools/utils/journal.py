@@ -0,0 +1,97 @@
+import json
+import threading
+import time
+import uuid
+from typing import Dict, Optional
+
+from xnat_admin_tools.utils.cache import cache_path
+
+
+class RunJournal:
+    """
+    Append-only JSONL checkpoint of the items (e.g. projects) a run completed
+
+    The first line of the file marks the start of a run, every item completed
+    appends a line and a finished run appends a final line. A new run
+    truncates the file; a resumed run keeps appending to the last run if it did
+    not finish, so `done` skips what it already completed. Items can carry a
+    version (e.g. a snapshot hash) so they are redone if they changed since.
+    """
+
+    def __init__(self, name: str, resume: bool = False, path: Optional[str] = None):
+        self.path = path or cache_path(f"journal-{name}.jsonl")
+        self.completed: Dict[str, Optional[str]] = {}
+        self.run_id: Optional[str] = None
+        self._torn = False
+        self._lock = threading.Lock()
+
+        if resume:
+            self._load()
+
+        if self.run_id is None:
+            self.run_id = uuid.uuid4().hex
+            self._file = open(self.path, "w")
+            self._write({"event": "start"})
+        else:
+            self._file = open(self.path, "a")
+            if self._torn:
+                self._file.write("\n")
+
+    def _load(self):
+        """Pick up the last run of the file, unless it finished"""
+        try:
+            with open(self.path) as f:
+                lines = f.readlines()
+        except OSError:
+            return
+
+        # the last line was cut short by the crash
+        self._torn = bool(lines) and not lines[-1].endswith("\n")
+
+        entries = []
+        for line in lines:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+
+        if not entries or entries[0].get("event") != "start":
+            return
+        if any(entry.get("event") == "finish" for entry in entries):
+            return
+
+        self.run_id = entries[0]["run"]
+        for entry in entries:
+            if entry.get("status") == "done":
+                self.completed[entry["item"]] = entry.get("version")
+
+    def _write(self, entry: dict):
+        entry.update(run=self.run_id, at=time.time())
+        with self._lock:
+            self._file.write(json.dumps(entry) + "\n")
+            self._file.flush()
+
+    @property
+    def resumed(self) -> bool:
+        return bool(self.completed)
+
+    def done(self, item: str, version: Optional[str] = None) -> bool:
+        """Whether the run already completed `item` (at this version)"""
+        return item in self.completed and self.completed[item] == version
+
+    def record(self, item: str, ok: bool, version: Optional[str] = None, **info):
+        """Append the outcome of an item"""
+        entry = {"item": item, "status": "done" if ok else "failed", **info}
+        if version is not None:
+            entry["version"] = version
+        self._write(entry)
+        if ok:
+            self.completed[item] = version
+
+    def finish(self):
+        """Mark the run as complete, the next --resume starts over"""
+        self._write({"event": "finish"})
+        self.close()
+
+    def close(self):
+        self._file.close()
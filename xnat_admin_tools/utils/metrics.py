@@ -0,0 +1,281 @@
+import atexit
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse
+
+import typer
+
+# Same defaults as the Prometheus client libraries, plus a few slow buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+logger = logging.getLogger(__name__)
+
+# Hash accumulating the observations of every RQ job
+REDIS_KEY = "xnat_admin:metrics"
+
+# Path segments following these are IDs, replaced by {id} to bound the series
+ID_PARENTS = {
+    "projects",
+    "subjects",
+    "experiments",
+    "scans",
+    "resources",
+    "files",
+    "syncexperiment",
+}
+
+
+@dataclass
+class Series:
+    """Latency histogram and error count of one (kind, host, endpoint)"""
+
+    buckets: List[int] = field(default_factory=lambda: [0] * len(BUCKETS))
+    count: int = 0
+    errors: int = 0
+    total: float = 0.0
+    max: float = 0.0
+
+
+class Metrics:
+    """
+    In-process registry of call latencies, written out in the Prometheus
+    text exposition format
+    """
+
+    def __init__(self):
+        self.series: Dict[Tuple[str, str, str], Series] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, kind: str, host: str, endpoint: str, seconds: float, error: bool):
+        with self._lock:
+            series = self.series.setdefault((kind, host, endpoint), Series())
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    series.buckets[i] += 1
+            series.count += 1
+            series.errors += int(error)
+            series.total += seconds
+            series.max = max(series.max, seconds)
+
+    def exposition(self) -> str:
+        name = "xnat_admin_call_duration_seconds"
+        lines = [
+            f"# HELP {name} Duration of calls to XNAT hosts and of RQ jobs",
+            f"# TYPE {name} histogram",
+        ]
+        errors = [
+            "# HELP xnat_admin_call_errors_total Calls that failed or returned >= 400",
+            "# TYPE xnat_admin_call_errors_total counter",
+        ]
+        with self._lock:
+            for (kind, host, endpoint), series in sorted(self.series.items()):
+                labels = (
+                    f'kind="{_escape(kind)}",host="{_escape(host)}",'
+                    f'endpoint="{_escape(endpoint)}"'
+                )
+                for bound, count in zip(BUCKETS, series.buckets):
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {series.count}')
+                lines.append(f"{name}_sum{{{labels}}} {series.total}")
+                lines.append(f"{name}_count{{{labels}}} {series.count}")
+                errors.append(
+                    f"xnat_admin_call_errors_total{{{labels}}} {series.errors}"
+                )
+        return "\n".join(lines + errors) + "\n"
+
+    def flush_to_redis(self, redis_conn):
+        """
+        Add the observations to the totals kept in Redis and start over, so
+        they are counted once whichever process flushes them
+        """
+        with self._lock:
+            series, self.series = self.series, {}
+
+        with redis_conn.pipeline() as pipe:
+            for labels, observed in series.items():
+                for i, count in enumerate(observed.buckets):
+                    if count:
+                        pipe.hincrby(REDIS_KEY, _redis_field(labels, str(i)), count)
+                pipe.hincrby(REDIS_KEY, _redis_field(labels, "count"), observed.count)
+                pipe.hincrby(REDIS_KEY, _redis_field(labels, "errors"), observed.errors)
+                pipe.hincrbyfloat(
+                    REDIS_KEY, _redis_field(labels, "total"), observed.total
+                )
+            pipe.execute()
+
+    @classmethod
+    def from_redis(cls, redis_conn) -> "Metrics":
+        """Totals of every flushed observation"""
+        metrics = cls()
+        for key, value in redis_conn.hgetall(REDIS_KEY).items():
+            kind, host, endpoint, name = json.loads(key)
+            series = metrics.series.setdefault((kind, host, endpoint), Series())
+            if name == "total":
+                series.total = float(value)
+            elif name in ("count", "errors"):
+                setattr(series, name, int(value))
+            else:
+                series.buckets[int(name)] = int(value)
+        return metrics
+
+    def write_textfile(self, path: str):
+        """Atomically write the metrics for the node exporter textfile collector"""
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write(self.exposition())
+        os.replace(tmp_path, path)
+
+    def summary(self) -> str:
+        """Per-endpoint table of calls, errors and time spent, slowest first"""
+        lines = [
+            f"{'KIND':<7} {'HOST':<28} {'ENDPOINT':<50} {'CALLS':>6} {'ERRORS':>6} "
+            f"{'TOTAL':>9} {'MEAN':>8} {'MAX':>8}"
+        ]
+        with self._lock:
+            ordered = sorted(self.series.items(), key=lambda item: -item[1].total)
+            for (kind, host, endpoint), series in ordered:
+                lines.append(
+                    f"{kind:<7} {host:<28} {endpoint:<50} {series.count:>6} "
+                    f"{series.errors:>6} {series.total:>8.2f}s "
+                    f"{series.total / series.count:>7.3f}s {series.max:>7.3f}s"
+                )
+        return "\n".join(lines)
+
+
+METRICS = Metrics()
+
+
+def _redis_field(labels: Tuple[str, str, str], name: str) -> str:
+    """Hash field of one value (a bucket index, count, errors or total) of a series"""
+    return json.dumps(list(labels) + [name])
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def endpoint_of(method: str, url: str) -> Tuple[str, str]:
+    """(host, "METHOD /path/{id}/...") of a request URL"""
+    parsed = urlparse(url)
+    segments = parsed.path.split("/")
+    for i in range(1, len(segments)):
+        if segments[i - 1] in ID_PARENTS and segments[i]:
+            segments[i] = "{id}"
+    return parsed.netloc, f"{method.upper()} {'/'.join(segments)}"
+
+
+@contextmanager
+def timed(kind: str, method: str, url: str):
+    """
+    Times the enclosed call to `url`. It counts as an error if it raises or
+    sets call["error"].
+    """
+    call = {"error": False}
+    start = time.monotonic()
+    try:
+        yield call
+    except BaseException:
+        call["error"] = True
+        raise
+    finally:
+        host, endpoint = endpoint_of(method, url)
+        METRICS.observe(kind, host, endpoint, time.monotonic() - start, call["error"])
+
+
+def instrument_pyxnat(interface):
+    """Times every REST call a pyxnat Interface makes"""
+    execute = interface._exec
+    server = interface._server
+
+    def _exec(uri, method="GET", *args, **kwargs):
+        url = uri if uri.startswith("http") else server + uri
+        with timed("pyxnat", method, url):
+            return execute(uri, method, *args, **kwargs)
+
+    interface._exec = _exec
+    return interface
+
+
+def timed_job(func):
+    """
+    Times an RQ job function
+
+    The default worker runs every job in a forked process that exits without
+    running atexit hooks, so the job's observations (its own duration and
+    the calls it made) are added to the totals in Redis when it ends. With
+    XNAT_METRICS_TEXTFILE set, the textfile is then rewritten from those
+    totals.
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        from rq import get_current_job
+
+        job = get_current_job()
+        start = time.monotonic()
+        error = True
+        try:
+            result = func(*args, **kwargs)
+            error = False
+            return result
+        finally:
+            METRICS.observe(
+                "job",
+                job.origin if job else "",
+                func.__name__,
+                time.monotonic() - start,
+                error,
+            )
+            if job:
+                # metrics never change the outcome of a job
+                try:
+                    export_job_metrics(job.connection)
+                except Exception:
+                    logger.exception("Could not export the metrics of job %s", job.id)
+
+    return wrapper
+
+
+def export_job_metrics(redis_conn):
+    """Flush the process's observations to Redis and write out the totals"""
+    METRICS.flush_to_redis(redis_conn)
+
+    path = os.environ.get("XNAT_METRICS_TEXTFILE")
+    if path:
+        # serialized so an older snapshot never replaces a newer one
+        with redis_conn.lock(f"{REDIS_KEY}:textfile", timeout=30, blocking_timeout=10):
+            Metrics.from_redis(redis_conn).write_textfile(path)
+
+
+def print_summary():
+    if METRICS.series:
+        typer.echo("\n" + METRICS.summary())
+
+
+_profiling = False
+
+
+def enable_profile():
+    """Print the per-endpoint summary when the command exits"""
+    global _profiling
+    if not _profiling:
+        atexit.register(print_summary)
+        _profiling = True
+
+
+def _export():
+    path = os.environ.get("XNAT_METRICS_TEXTFILE")
+    if path and METRICS.series:
+        METRICS.write_textfile(path)
+
+
+atexit.register(_export)
+if os.environ.get("XNAT_PROFILE", "").lower() in ("1", "true", "yes"):
+    enable_profile()
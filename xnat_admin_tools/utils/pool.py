@@ -0,0 +1,71 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, List, Optional
+
+import typer
+
+
+@dataclass
+class TaskResult:
+    """Outcome of running a task for a single item (e.g. a project)"""
+
+    item: Any
+    ok: bool
+    value: Any = None
+    error: Optional[str] = None
+    elapsed: float = 0.0
+
+
+def _run_one(func: Callable, item: Any) -> TaskResult:
+    start = time.monotonic()
+    try:
+        value = func(item)
+        return TaskResult(item, True, value, elapsed=time.monotonic() - start)
+    except Exception as e:
+        return TaskResult(item, False, error=str(e), elapsed=time.monotonic() - start)
+
+
+def run_parallel(
+    func: Callable[[Any], Any],
+    items: Iterable[Any],
+    workers: int = 1,
+    on_result: Optional[Callable[[TaskResult], None]] = None,
+) -> List[TaskResult]:
+    """
+    Run func(item) for every item through a bounded pool of worker threads
+
+    Exceptions are captured per item instead of aborting the run. `on_result`
+    is called (from the calling thread) as each item completes.
+    """
+    results = []
+
+    if workers <= 1:
+        for item in items:
+            result = _run_one(func, item)
+            if on_result:
+                on_result(result)
+            results.append(result)
+        return results
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_run_one, func, item) for item in items]
+        for future in as_completed(futures):
+            result = future.result()
+            if on_result:
+                on_result(result)
+            results.append(result)
+
+    return results
+
+
+def echo_summary(results: List[TaskResult], elapsed: float, label: str = "items"):
+    """Print a success/failure summary for a run"""
+    failed = [r for r in results if not r.ok]
+    rate = len(results) / elapsed if elapsed > 0 else 0.0
+    typer.echo(
+        f"Processed {len(results)} {label} in {elapsed:.1f}s ({rate:.2f}/s): "
+        f"{len(results) - len(failed)} succeeded, {len(failed)} failed"
+    )
+    for result in failed:
+        typer.echo(f"  FAILED {result.item}: {result.error}")
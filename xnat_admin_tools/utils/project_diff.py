@@ -0,0 +1,77 @@
+import hashlib
+import json
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, Optional
+
+from xnat_admin_tools.utils.cache import cache_path, host_slug, load_json, save_json
+
+CREATE = "create"
+UPDATE = "update"
+DELETE = "delete"
+
+
+@dataclass
+class ProjectAction:
+    """A change needed to bring a destination project in line with its source"""
+
+    kind: str
+    project_id: str
+    snapshot: dict = field(default_factory=dict)
+
+    def __str__(self):
+        return f"{self.kind} {self.project_id}"
+
+
+def project_hash(snapshot: dict) -> str:
+    """Content hash of a project snapshot"""
+    return hashlib.sha1(json.dumps(snapshot, sort_keys=True).encode()).hexdigest()
+
+
+class ProjectDiff:
+    """
+    Diffs source project snapshots against the state recorded on the last run
+
+    The state is a JSON file mapping project ID to the content hash of the
+    snapshot last replicated from the source to the destination. Only projects
+    missing on the destination or whose hash changed produce an action.
+    """
+
+    def __init__(self, src_host: str, dst_host: str, path: Optional[str] = None):
+        self.path = path or cache_path(
+            f"project-state-{host_slug(src_host)}--{host_slug(dst_host)}.json"
+        )
+        self.hashes: Dict[str, str] = load_json(self.path, {})
+
+    def actions(
+        self, snapshots: Dict[str, dict], dst_project_ids: Iterable[str]
+    ) -> Iterator[ProjectAction]:
+        """
+        Yield the create/update/delete actions for the source snapshots
+
+        Without a previous state, projects already on the destination are
+        recorded as the baseline instead of being updated.
+        """
+        dst_project_ids = set(dst_project_ids)
+        baseline = not self.hashes
+
+        for project_id in sorted(snapshots):
+            snapshot = snapshots[project_id]
+            if project_id not in dst_project_ids:
+                yield ProjectAction(CREATE, project_id, snapshot)
+            elif baseline:
+                self.hashes[project_id] = project_hash(snapshot)
+            elif self.hashes.get(project_id) != project_hash(snapshot):
+                yield ProjectAction(UPDATE, project_id, snapshot)
+
+        for project_id in sorted(set(self.hashes) - set(snapshots)):
+            yield ProjectAction(DELETE, project_id)
+
+    def record(self, action: ProjectAction):
+        """Mark an action as applied"""
+        if action.kind == DELETE:
+            self.hashes.pop(action.project_id, None)
+        else:
+            self.hashes[action.project_id] = project_hash(action.snapshot)
+
+    def save(self):
+        save_json(self.path, self.hashes)
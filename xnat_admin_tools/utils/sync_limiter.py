@@ -0,0 +1,106 @@
+import os
+import time
+import uuid
+from typing import Optional
+
+from xnat_admin_tools.utils.cache import host_slug
+
+# KEYS[1]: sorted set of in-flight tokens scored by lease expiry
+# KEYS[2]: token bucket hash {tokens, ts}
+# ARGV: now, max_in_flight, rate, burst, lease, token
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local lease = tonumber(ARGV[5])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+
+local rate = tonumber(ARGV[3])
+if rate > 0 then
+    local burst = tonumber(ARGV[4])
+    local tokens = tonumber(redis.call('HGET', KEYS[2], 'tokens') or burst)
+    local ts = tonumber(redis.call('HGET', KEYS[2], 'ts') or now)
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    if tokens < 1 then
+        redis.call('HMSET', KEYS[2], 'tokens', tokens, 'ts', now)
+        return 0
+    end
+    redis.call('HMSET', KEYS[2], 'tokens', tokens - 1, 'ts', now)
+    redis.call('EXPIRE', KEYS[2], math.ceil(burst / rate) + 60)
+end
+
+redis.call('ZADD', KEYS[1], now + lease, ARGV[6])
+redis.call('EXPIRE', KEYS[1], math.ceil(lease) + 60)
+return 1
+"""
+
+
+class SyncLimiter:
+    """
+    Redis-backed limit on the xsync triggers sent to one relay host, shared
+    by every RQ worker
+
+    A trigger needs a free in-flight slot (at most `max_in_flight`, each held
+    for `lease` seconds unless renewed or released) and a token from a bucket
+    refilled at `rate` per second (0 disables the rate limit). Both checks run
+    atomically in a Lua script.
+    """
+
+    def __init__(
+        self,
+        redis_conn,
+        host: str,
+        max_in_flight: Optional[int] = None,
+        rate: Optional[float] = None,
+        burst: Optional[int] = None,
+        lease: Optional[float] = None,
+    ):
+        self.redis_conn = redis_conn
+        self.max_in_flight = max_in_flight or int(
+            os.environ.get("XSYNC_MAX_IN_FLIGHT", "4")
+        )
+        self.rate = (
+            rate if rate is not None else float(os.environ.get("XSYNC_RATE", "0"))
+        )
+        self.burst = burst or int(os.environ.get("XSYNC_BURST", self.max_in_flight))
+        self.lease = lease or float(os.environ.get("XSYNC_INFLIGHT_LEASE", "300"))
+
+        slug = host_slug(host)
+        self.in_flight_key = f"xsync:inflight:{slug}"
+        self.bucket_key = f"xsync:bucket:{slug}"
+        self._acquire = redis_conn.register_script(ACQUIRE_SCRIPT)
+
+    def try_acquire(self) -> Optional[str]:
+        """Take a slot, returning its token, or None if the host is saturated"""
+        token = uuid.uuid4().hex
+        acquired = self._acquire(
+            keys=[self.in_flight_key, self.bucket_key],
+            args=[
+                time.time(),
+                self.max_in_flight,
+                self.rate,
+                self.burst,
+                self.lease,
+                token,
+            ],
+        )
+        return token if acquired else None
+
+    def renew(self, token: str) -> bool:
+        """Extend the lease of a held slot, False if it already expired"""
+        with self.redis_conn.pipeline() as pipe:
+            pipe.zadd(
+                self.in_flight_key, {token: time.time() + self.lease}, xx=True, ch=True
+            )
+            pipe.expire(self.in_flight_key, int(self.lease) + 60)
+            renewed, _ = pipe.execute()
+        return bool(renewed)
+
+    def release(self, token: str):
+        """Free a slot before its lease expires"""
+        self.redis_conn.zrem(self.in_flight_key, token)
+
+    def in_flight(self) -> int:
+        self.redis_conn.zremrangebyscore(self.in_flight_key, "-inf", time.time())
+        return self.redis_conn.zcard(self.in_flight_key)
@@ -0,0 +1,302 @@
+import math
+import os
+import time
+from datetime import timedelta
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from xnat_admin_tools.utils.client import closing_clients, get_client
+from xnat_admin_tools.utils.metrics import timed_job
+from xnat_admin_tools.utils.sync_limiter import SyncLimiter
+from xnat_admin_tools.utils.xsync_index import get_xsync_index
+
+# Hash with the tracking record of an experiment's latest sync
+TRACK_KEY = "xsync:track:{}"
+# Experiment IDs of tracked syncs scored by trigger time
+TRACKED_KEY = "xsync:tracked"
+
+RUNNING = "running"
+FINISHED = "finished"
+TIMEOUT = "timeout"
+UNTRACKED = "untracked"
+MISSING = "missing"
+
+
+def files_listing(
+    host: str, user: str, password: str, path: str
+) -> Tuple[int, Optional[Tuple[int, int]]]:
+    """
+    Status code of listing a files resource (e.g.
+    /data/experiments/{id}/scans/ALL/files) and its number of files and total
+    bytes, None if it could not be listed
+    """
+    client = get_client(host, user, password)
+    response = client.get(host + path, params={"format": "json"})
+    if response.status_code != 200:
+        return response.status_code, None
+
+    files = response.json()["ResultSet"]["Result"]
+    return 200, (len(files), sum(int(f.get("Size") or 0) for f in files))
+
+
+def files_signature(
+    host: str, user: str, password: str, path: str
+) -> Optional[Tuple[int, int]]:
+    """
+    Number of files and total bytes listed by a files resource, None if it
+    could not be listed
+    """
+    return files_listing(host, user, password, path)[1]
+
+
+def remote_experiment_path(experiment_id: str) -> Optional[str]:
+    """
+    Files resource of the experiment's copy on the server, found through its
+    label and the XSync config of its project on the relay
+    """
+    xrelay_host = os.environ.get("XNAT_RELAY_HOST", "")
+    xrelay_user = os.environ.get("XNAT_RELAY_USER", "")
+    xrelay_pass = os.environ.get("XNAT_RELAY_PASS", "")
+
+    client = get_client(xrelay_host, xrelay_user, xrelay_pass)
+    response = client.get(
+        xrelay_host + f"/data/experiments/{experiment_id}", params={"format": "json"}
+    )
+    if response.status_code != 200:
+        return None
+
+    try:
+        data_fields = response.json()["items"][0]["data_fields"]
+        label = data_fields["label"]
+        remote_project_id = get_xsync_index(
+            xrelay_host, xrelay_user, xrelay_pass
+        ).remote_project_id(data_fields["project"])
+    except (KeyError, IndexError, ValueError):
+        return None
+
+    return f"/data/projects/{remote_project_id}/experiments/{label}/scans/ALL/files"
+
+
+def start_tracking(
+    redis_conn,
+    experiment_id: str,
+    label_id: str,
+    job_id: Optional[str],
+    expected: Optional[Tuple[int, int]],
+    limiter_token: Optional[str] = None,
+):
+    """Records a triggered sync, to be completed by track_sync"""
+    ttl = int(os.environ.get("XSYNC_TRACK_TTL", "604800"))
+    now = time.time()
+    record = {
+        "experiment_id": experiment_id,
+        "label_id": label_id,
+        "job_id": job_id or "",
+        "status": RUNNING,
+        "triggered": now,
+        "files": expected[0] if expected else "",
+        "bytes": expected[1] if expected else "",
+        "limiter_token": limiter_token or "",
+    }
+    key = TRACK_KEY.format(experiment_id)
+    with redis_conn.pipeline() as pipe:
+        pipe.delete(key)
+        pipe.hmset(key, record)
+        pipe.expire(key, ttl)
+        pipe.zadd(TRACKED_KEY, {experiment_id: now})
+        pipe.zremrangebyscore(TRACKED_KEY, "-inf", now - ttl)
+        pipe.execute()
+
+
+def finish_tracking(redis_conn, experiment_id: str, status: str, **fields):
+    """
+    Closes a tracking record and frees its slot on the relay. `finished`
+    defaults to now.
+    """
+    key = TRACK_KEY.format(experiment_id)
+    record = get_tracking(redis_conn, experiment_id)
+    if not record:
+        return
+
+    finished = float(fields.pop("finished", time.time()))
+    fields.update(status=status, finished=finished)
+    if status == FINISHED:
+        duration = finished - float(record["triggered"])
+        fields["duration"] = duration
+        if record.get("bytes"):
+            fields["throughput"] = int(record["bytes"]) / max(duration, 1e-6)
+    redis_conn.hmset(key, fields)
+
+    if record.get("limiter_token"):
+        SyncLimiter(redis_conn, os.environ.get("XNAT_RELAY_HOST", "")).release(
+            record["limiter_token"]
+        )
+
+
+@timed_job
+@closing_clients
+def track_sync(experiment_id, label_id):
+    """
+    Checks whether a triggered sync landed on the server
+
+    The sync is complete once the experiment's copy on the server lists the
+    same number of files and bytes as the relay did when the sync was
+    triggered, or at least as many, or once its copy stopped changing for
+    XSYNC_TRACK_SETTLE seconds (server side files, or a relay session that
+    changed after the trigger, keep the counts from matching). Until then the
+    job reschedules itself every XSYNC_TRACK_INTERVAL seconds, renewing the
+    sync's in-flight slot for XSYNC_TRACK_HOLD seconds at most. It gives up
+    after XSYNC_TRACK_TIMEOUT, or after XSYNC_TRACK_MISSING_TIMEOUT if the
+    server never had the experiment.
+    """
+    from xnat_admin_tools.initiate_sync import get_redis_queue, session_signature
+
+    timeout = int(os.environ.get("XSYNC_TRACK_TIMEOUT", "86400"))
+    missing_timeout = int(os.environ.get("XSYNC_TRACK_MISSING_TIMEOUT", "3600"))
+    settle = int(os.environ.get("XSYNC_TRACK_SETTLE", "600"))
+    hold = int(os.environ.get("XSYNC_TRACK_HOLD", "3600"))
+
+    redis_queue = get_redis_queue()
+    redis_conn = redis_queue.connection
+    record = get_tracking(redis_conn, experiment_id)
+    if not record or record["status"] != RUNNING:
+        return "no running sync tracked for {}".format(experiment_id)
+
+    if record["files"] == "":
+        expected = session_signature(experiment_id)
+        if expected is None:
+            finish_tracking(redis_conn, experiment_id, UNTRACKED)
+            return "could not list {} on the relay".format(experiment_id)
+        redis_conn.hmset(
+            TRACK_KEY.format(experiment_id),
+            {"files": expected[0], "bytes": expected[1]},
+        )
+    else:
+        expected = (int(record["files"]), int(record["bytes"]))
+
+    remote_path = remote_experiment_path(experiment_id)
+    if remote_path is None:
+        finish_tracking(redis_conn, experiment_id, UNTRACKED)
+        return "could not find where {} syncs to".format(experiment_id)
+
+    status_code, landed = files_listing(
+        os.environ.get("XNAT_SERVER_HOST", ""),
+        os.environ.get("XNAT_SERVER_USER", ""),
+        os.environ.get("XNAT_SERVER_PASS", ""),
+        remote_path,
+    )
+    if landed and landed[0] >= expected[0] and landed[1] >= expected[1]:
+        finish_tracking(redis_conn, experiment_id, FINISHED)
+        return "xsync on {} finished: {} files, {} bytes".format(experiment_id, *landed)
+
+    now = time.time()
+    if landed and landed[0] > 0:
+        signature = "{},{}".format(*landed)
+        if record.get("landed") != signature:
+            redis_conn.hmset(
+                TRACK_KEY.format(experiment_id),
+                {"landed": signature, "landed_at": now},
+            )
+        elif now - float(record["landed_at"]) >= settle:
+            # finished when the copy last changed
+            finish_tracking(
+                redis_conn,
+                experiment_id,
+                FINISHED,
+                finished=record["landed_at"],
+                settled=1,
+            )
+            return "xsync on {} settled at {} files, {} bytes of {}, {}".format(
+                experiment_id, *landed, *expected
+            )
+
+    elapsed = now - float(record["triggered"])
+    if status_code != 404 and not record.get("seen"):
+        redis_conn.hset(TRACK_KEY.format(experiment_id), "seen", 1)
+    elif status_code == 404 and not record.get("seen") and elapsed > missing_timeout:
+        finish_tracking(redis_conn, experiment_id, MISSING)
+        return "{} not found at {} after {}s".format(
+            experiment_id, remote_path, missing_timeout
+        )
+
+    if elapsed > timeout:
+        finish_tracking(redis_conn, experiment_id, TIMEOUT)
+        return "xsync on {} not complete after {}s".format(experiment_id, timeout)
+
+    # The transfer still runs, keep its slot on the relay for a while
+    if record.get("limiter_token"):
+        limiter = SyncLimiter(redis_conn, os.environ.get("XNAT_RELAY_HOST", ""))
+        if elapsed < hold:
+            limiter.renew(record["limiter_token"])
+        else:
+            limiter.release(record["limiter_token"])
+
+    schedule_tracking(redis_queue, experiment_id, label_id)
+    return "xsync on {} in progress: {} of {} files on the server".format(
+        experiment_id, landed[0] if landed else 0, expected[0]
+    )
+
+
+def schedule_tracking(redis_queue, experiment_id, label_id):
+    """Schedules track_sync XSYNC_TRACK_INTERVAL seconds from now"""
+    interval = int(os.environ.get("XSYNC_TRACK_INTERVAL", "60"))
+    return redis_queue.enqueue_in(
+        timedelta(seconds=interval),
+        track_sync,
+        args=(experiment_id, label_id),
+        job_timeout=600,
+        result_ttl=604800,
+    )
+
+
+def get_tracking(redis_conn, experiment_id: str) -> Dict[str, str]:
+    record = redis_conn.hgetall(TRACK_KEY.format(experiment_id))
+    return {key.decode(): value.decode() for key, value in record.items()}
+
+
+def tracked_syncs(redis_conn, limit: int = 100) -> List[Dict[str, str]]:
+    """Tracking records of the latest `limit` syncs, newest first"""
+    experiment_ids = redis_conn.zrevrange(TRACKED_KEY, 0, limit - 1)
+    with redis_conn.pipeline() as pipe:
+        for experiment_id in experiment_ids:
+            pipe.hgetall(TRACK_KEY.format(experiment_id.decode()))
+        records = pipe.execute()
+    return [
+        {key.decode(): value.decode() for key, value in record.items()}
+        for record in records
+        if record
+    ]
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    """Nearest-rank percentile of `values`, 0 if empty"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = math.ceil(q / 100 * len(ordered)) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+
+def summarize(records: Sequence[Dict[str, str]]) -> dict:
+    """Counts per status plus latency and throughput of the finished syncs"""
+    counts: Dict[str, int] = {}
+    for record in records:
+        counts[record["status"]] = counts.get(record["status"], 0) + 1
+
+    finished = [record for record in records if record["status"] == FINISHED]
+    durations = [float(record["duration"]) for record in finished]
+    total_bytes = sum(int(record["bytes"] or 0) for record in finished)
+    window = (
+        max(float(r["finished"]) for r in finished)
+        - min(float(r["triggered"]) for r in finished)
+        if finished
+        else 0
+    )
+
+    return {
+        "counts": counts,
+        "p50": percentile(durations, 50),
+        "p95": percentile(durations, 95),
+        "max": max(durations, default=0.0),
+        "bytes": total_bytes,
+        "throughput": total_bytes / window if window else 0.0,
+    }
@@ -0,0 +1,110 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+from xnat_admin_tools.utils.cache import host_slug
+from xnat_admin_tools.utils.client import get_client
+
+# Token shared by the processes using the same Redis, e.g. forked RQ jobs
+TOKEN_KEY = "xnat_admin:token:{}:{}"
+
+
+class XNATTokenProvider:
+    """
+    Issues XNAT alias tokens for a host and hands out the same token until it
+    is about to expire, so a run touching many projects leaves a single live
+    token on the server.
+
+    With `redis_conn` the token is also kept in Redis until the margin, so
+    processes that each start afresh (RQ work horses) share it too.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        refresh_margin: Optional[float] = None,
+        redis_conn=None,
+    ):
+        self.host = host
+        self.user = user
+        self.password = password
+        # seconds before estimatedExpirationTime after which a new token is issued
+        self.refresh_margin = (
+            refresh_margin
+            if refresh_margin is not None
+            else float(os.environ.get("XNAT_TOKEN_REFRESH_MARGIN", "3600"))
+        )
+        self.redis_conn = redis_conn
+        self._token: Optional[dict] = None
+        self._lock = threading.Lock()
+
+    def _expires_at(self, token: dict) -> float:
+        # XNAT reports the expiration as epoch milliseconds
+        return float(token["estimatedExpirationTime"]) / 1000
+
+    def _issue(self) -> dict:
+        client = get_client(self.host, self.user, self.password)
+        R = client.get(
+            self.host + "/data/services/tokens/issue",
+            headers={"Content-Type": "application/json"},
+        )
+        R.raise_for_status()
+        return R.json()
+
+    def _fresh(self, token: dict) -> bool:
+        return self._expires_at(token) - time.time() >= self.refresh_margin
+
+    def _shared(self) -> dict:
+        """The token kept in Redis, issued by whichever process gets there first"""
+        key = TOKEN_KEY.format(host_slug(self.host), self.user)
+
+        def cached() -> Optional[dict]:
+            value = self.redis_conn.get(key)
+            return json.loads(value) if value else None
+
+        token = cached()
+        if token is not None and self._fresh(token):
+            return token
+
+        with self.redis_conn.lock(f"{key}:lock", timeout=60, blocking_timeout=60):
+            token = cached()
+            if token is None or not self._fresh(token):
+                token = self._issue()
+                ttl = int(self._expires_at(token) - time.time() - self.refresh_margin)
+                if ttl > 0:
+                    self.redis_conn.set(key, json.dumps(token), ex=ttl)
+            return token
+
+    def token(self) -> dict:
+        """
+        Return the current token (alias, secret, estimatedExpirationTime),
+        issuing a new one if there is none or it expires within the margin
+        """
+        with self._lock:
+            if self._token is None or not self._fresh(self._token):
+                self._token = self._shared() if self.redis_conn else self._issue()
+            return self._token
+
+
+_providers: Dict[Tuple[str, str], XNATTokenProvider] = {}
+_providers_lock = threading.Lock()
+
+
+def get_token_provider(
+    host: str, user: str, password: str, redis_conn=None
+) -> XNATTokenProvider:
+    """
+    Return the shared token provider for (host, user), sharing its token
+    through `redis_conn` from then on if given
+    """
+    key = (host.rstrip("/"), user)
+    with _providers_lock:
+        if key not in _providers:
+            _providers[key] = XNATTokenProvider(host, user, password)
+        if redis_conn is not None:
+            _providers[key].redis_conn = redis_conn
+        return _providers[key]
@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from xnat_admin_tools.utils.cache import cache_path, host_slug, load_json, save_json
+from xnat_admin_tools.utils.client import get_client
+from xnat_admin_tools.utils.pool import TaskResult, run_parallel
+
+
+class XSyncIndex:
+    """
+    Local index of the latest XSync config of every project on a relay
+
+    Entries map project ID to {"remote_project_id", "config", "etag",
+    "last_modified", "fetched_at"} and are persisted to the cache directory.
+    An entry younger than `ttl` seconds is used as is; older entries are
+    revalidated with a conditional GET, so only configs that changed are
+    downloaded again.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        user: str,
+        password: str,
+        path: Optional[str] = None,
+        ttl: Optional[float] = None,
+    ):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.path = path or cache_path(f"xsync-index-{host_slug(host)}.json")
+        self.ttl = (
+            ttl
+            if ttl is not None
+            else float(os.environ.get("XNAT_XSYNC_INDEX_TTL", "86400"))
+        )
+        self.entries: Dict[str, dict] = load_json(self.path, {})
+        self._lock = threading.Lock()
+
+    def _is_fresh(self, project_id: str) -> bool:
+        entry = self.entries.get(project_id)
+        return entry is not None and time.time() - entry["fetched_at"] < self.ttl
+
+    def _fetch(self, project_id: str) -> dict:
+        entry = self.entries.get(project_id)
+        headers = {"Content-Type": "application/json"}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        client = get_client(self.host, self.user, self.password)
+        R = client.get(
+            self.host + f"/data/projects/{project_id}/config/xsync", headers=headers
+        )
+
+        if R.status_code == 304 and entry:
+            return dict(entry, fetched_at=time.time())
+
+        R.raise_for_status()
+        response = R.json()
+
+        # XNAT stores all prior versions of XSync configs per project.
+        # Fetching the latest (-1 index).
+        config = json.loads(response["ResultSet"]["Result"][-1]["contents"])
+        return {
+            "remote_project_id": config["remote_project_id"],
+            "config": config,
+            "etag": R.headers.get("ETag"),
+            "last_modified": R.headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        }
+
+    def refresh(self, project_ids: Iterable[str], workers: int = 1) -> List[TaskResult]:
+        """Fetch, in parallel, the configs of projects missing or stale in the index"""
+        stale = [p for p in project_ids if not self._is_fresh(p)]
+
+        def store(result: TaskResult):
+            if result.ok:
+                with self._lock:
+                    self.entries[result.item] = result.value
+
+        results = run_parallel(self._fetch, stale, workers, on_result=store)
+        if stale:
+            self.save()
+        return results
+
+    def get(self, project_id: str) -> dict:
+        """Latest XSync config entry of a project, fetched if not indexed"""
+        if not self._is_fresh(project_id):
+            entry = self._fetch(project_id)
+            with self._lock:
+                self.entries[project_id] = entry
+            self.save()
+        return self.entries[project_id]
+
+    def remote_project_id(self, project_id: str) -> str:
+        return self.get(project_id)["remote_project_id"]
+
+    def invalidate(self, project_id: str):
+        """Force the next lookup of a project to go to the server"""
+        with self._lock:
+            entry = self.entries.get(project_id)
+            if entry:
+                entry["fetched_at"] = 0
+        if entry:
+            self.save()
+
+    def save(self):
+        with self._lock:
+            save_json(self.path, self.entries)
+
+
+_indexes: Dict[Tuple[str, str], XSyncIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_xsync_index(host: str, user: str, password: str) -> XSyncIndex:
+    """Return the shared XSync config index of a relay for (host, user)"""
+    key = (host.rstrip("/"), user)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = XSyncIndex(host, user, password)
+        return _indexes[key]
+
+
+def invalidate_project(host: str, project_id: str):
+    """
+    Force the next lookup of a project's config to go to the server, in every
+    index of the relay (they share the cache file)
+    """
+    host = host.rstrip("/")
+    with _indexes_lock:
+        indexes = [index for key, index in _indexes.items() if key[0] == host]
+    if not indexes:
+        indexes = [XSyncIndex(host, "", "")]
+    for index in indexes:
+        index.invalidate(project_id)